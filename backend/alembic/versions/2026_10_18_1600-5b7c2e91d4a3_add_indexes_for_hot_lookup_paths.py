@@ -0,0 +1,41 @@
+"""
+
+add indexes for hot lookup paths
+
+Revision ID: 5b7c2e91d4a3
+Revises: 33586d9c17bb
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7c2e91d4a3'
+down_revision = '33586d9c17bb'
+branch_labels = None
+depends_on = None
+
+# The unique constraints on course_users, course_conflicts_of_interest, and course_grading_assignment_pairs already
+# exist from revision 71eea036bf8e, and their indexes serve lookups on their leading columns, i.e.
+# course_users(course_id, email), course_conflicts_of_interest(course_id, grader_email), and
+# course_grading_assignment_pairs(course_grading_assignment_id, ...). These are the lookups nothing covers yet.
+
+
+def upgrade() -> None:
+    # Every API request looks up its session by hashed token
+    op.create_index('ix_sessions_hashed_token', 'sessions', ['hashed_token'], unique=False)
+    # Finding every course a grader is in
+    op.create_index('ix_course_users_email', 'course_users', ['email'], unique=False)
+    # Finding a student's conflicts of interest
+    op.create_index('ix_course_conflicts_of_interest_course_id_student_email', 'course_conflicts_of_interest',
+                    ['course_id', 'student_email'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_course_conflicts_of_interest_course_id_student_email',
+                  table_name='course_conflicts_of_interest')
+    op.drop_index('ix_course_users_email', table_name='course_users')
+    op.drop_index('ix_sessions_hashed_token', table_name='sessions')
@@ -0,0 +1,29 @@
+"""
+
+add session retention indexes
+
+Revision ID: 9e41c0b7a2f6
+Revises: 5b7c2e91d4a3
+Create Date: 2026-10-18 16:30:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e41c0b7a2f6'
+down_revision = '5b7c2e91d4a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Used by SessionPruner to find sessions that expired before the retention window, and by SessionRevocationList
+    # to find the logged out sessions that haven't expired yet
+    op.create_index('ix_sessions_expires_at', 'sessions', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_sessions_expires_at', table_name='sessions')
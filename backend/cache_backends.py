@@ -0,0 +1,124 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Hashable, Tuple
+
+import cachetools
+from dotenv import load_dotenv
+
+logger = logging.getLogger("portal")
+
+load_dotenv()  # Backends are created when the decorated modules are imported, before server.py loads .env
+
+# Where the caches in backend/caching.py keep their entries
+# memory: a TTL cache in each worker process, so each worker fetches every key itself
+# sqlite: a SQLite file shared by every worker on the host, which also survives worker restarts
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "mount/cache.sqlite3")
+
+
+class MemoryCacheBackend:
+    # Entries live in this process only, like cachetools.func.ttl_cache
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float):
+        self.__cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.__lock = threading.Lock()  # cachetools caches aren't thread-safe
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        # Returns (True, value) for a live entry and (False, None) otherwise
+        with self.__lock:
+            try:
+                return True, self.__cache[key]
+            except KeyError:
+                return False, None
+
+    def set(self, key: Hashable, value: Any):
+        with self.__lock:
+            self.__cache[key] = value
+
+    def size(self) -> int:
+        with self.__lock:
+            return len(self.__cache)
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+
+
+class SqliteCacheBackend:
+    # Entries live in a SQLite file so every worker process shares them
+    # Values are pickled, so they must be plain data like the dicts returned by Autolab
+    # Each namespace (one per cached function) keeps at most maxsize entries; the ones closest to expiring are evicted
+    # first. Errors are logged and treated as misses so a broken cache file never breaks a request.
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float, path: str = CACHE_SQLITE_PATH):
+        self.__namespace = namespace
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+        self.__path = path
+        self.__local = threading.local()  # sqlite3 connections can't be shared between threads
+
+    def __connection(self) -> sqlite3.Connection:
+        local = self.__local
+        if getattr(local, "pid", None) != os.getpid():
+            # Autocommit mode, and WAL so readers in other workers don't wait for writers
+            connection = sqlite3.connect(self.__path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_entries (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                               "value BLOB NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (namespace, key))")
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        try:
+            row = self.__connection().execute(
+                "SELECT value FROM cache_entries WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (self.__namespace, repr(key), time.time())).fetchone()
+            if row is None:
+                return False, None
+            return True, pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError) as e:
+            logger.warning(f"Reading from the {self.__namespace} cache failed: {e}")
+            return False, None
+
+    def set(self, key: Hashable, value: Any):
+        now = time.time()
+        try:
+            connection = self.__connection()
+            connection.execute("INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at) "
+                               "VALUES (?, ?, ?, ?)",
+                               (self.__namespace, repr(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                now + self.__ttl))
+            connection.execute("DELETE FROM cache_entries WHERE namespace = ? AND (expires_at <= ? OR key IN "
+                               "(SELECT key FROM cache_entries WHERE namespace = ? ORDER BY expires_at DESC "
+                               "LIMIT -1 OFFSET ?))",
+                               (self.__namespace, now, self.__namespace, self.__maxsize))
+        except sqlite3.Error as e:
+            logger.warning(f"Writing to the {self.__namespace} cache failed: {e}")
+
+    def size(self) -> int:
+        try:
+            return self.__connection().execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ? AND "
+                                               "expires_at > ?", (self.__namespace, time.time())).fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def clear(self):
+        try:
+            self.__connection().execute("DELETE FROM cache_entries WHERE namespace = ?", (self.__namespace,))
+        except sqlite3.Error as e:
+            logger.warning(f"Clearing the {self.__namespace} cache failed: {e}")
+
+
+def create_cache_backend(namespace: str, maxsize: int, ttl: float):
+    # Returns the backend selected by CACHE_BACKEND
+    if CACHE_BACKEND == "sqlite":
+        return SqliteCacheBackend(namespace, maxsize, ttl)
+    if CACHE_BACKEND != "memory":
+        logger.warning(f"Unknown CACHE_BACKEND {CACHE_BACKEND}, using memory")
+    return MemoryCacheBackend(namespace, maxsize, ttl)
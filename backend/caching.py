@@ -0,0 +1,200 @@
+import concurrent.futures
+import functools
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import cachetools.keys
+from werkzeug.exceptions import GatewayTimeout
+
+from backend.cache_backends import create_cache_backend
+from backend.metrics import CACHE_REQUESTS
+from backend.request_deadline import abort_past_deadline, upstream_timeout
+
+logger = logging.getLogger("portal")
+
+_refresh_executor: Optional[ThreadPoolExecutor] = None
+_refresh_executor_pid: Optional[int] = None
+_refresh_executor_lock = threading.Lock()
+
+
+def _get_refresh_executor() -> ThreadPoolExecutor:
+    # Threads used for stale-while-revalidate refreshes
+    # Created lazily in each process because the threads of an executor created before a fork don't exist in the child
+    global _refresh_executor, _refresh_executor_pid
+    with _refresh_executor_lock:
+        if _refresh_executor_pid != os.getpid():
+            _refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache-refresh")
+            _refresh_executor_pid = os.getpid()
+        return _refresh_executor
+
+
+class SingleFlightTTLCache:
+    # A TTL cache in front of a function, like cachetools.func.ttl_cache, that also coalesces concurrent misses
+    # When an entry is missing or expired, the first caller for that key calls the function and every other caller
+    # in this process for the same key waits for that result instead of making its own upstream call. Exceptions are
+    # not cached, but they are passed to the callers that were waiting on the failed call, except for a 504 from the
+    # first caller's request deadline. Waiting callers give up at their own request's deadline.
+    # With max_stale > 0, an entry that is older than ttl but not older than ttl + max_stale is returned immediately
+    # and refreshed in the background (stale-while-revalidate). The refresh runs on a worker thread without a Flask
+    # request or app context, so only functions that don't need one should use max_stale.
+    # Entries are stored in the backend selected by CACHE_BACKEND (see backend/cache_backends.py).
+
+    def __init__(self, function: Callable, maxsize: int, ttl: float, key: Callable = cachetools.keys.hashkey,
+                 max_stale: float = 0):
+        self.__function = function
+        self.__name = function.__qualname__
+        self.__key = key
+        self.__ttl = ttl
+        self.__max_stale = max_stale
+        # Entries are kept for max_stale after they stop being fresh, and stored as (fresh_until, value)
+        self.__backend = create_cache_backend(self.__name, maxsize, ttl + max_stale)
+        self.__maxsize = maxsize
+        self.__in_flight: Dict[Hashable, Future] = {}
+        self.__lock = threading.Lock()  # Guards the in-flight calls and the counters
+        self.__counts = {"hit": 0, "stale": 0, "miss": 0, "coalesced": 0}
+
+    def __count(self, result: str):
+        CACHE_REQUESTS.labels(self.__name, result).inc()
+        with self.__lock:
+            self.__counts[result] += 1
+
+    def __call__(self, *args, **kwargs):
+        found, value = self.lookup(*args, **kwargs)
+        if found:
+            return value
+
+        key = self.__key(*args, **kwargs)
+        future, is_leader = self.__join_in_flight(key)
+        if not is_leader:
+            self.__count("coalesced")
+            return self.__wait(future, args, kwargs)
+        return self.__fetch(key, future, args, kwargs)
+
+    def __wait(self, future: Future, args: tuple, kwargs: dict):
+        # Waits for another caller's fetch, but no longer than this caller's own request deadline allows
+        timeout = upstream_timeout(math.inf)
+        try:
+            return future.result(timeout=None if math.isinf(timeout) else timeout)
+        except concurrent.futures.TimeoutError:
+            abort_past_deadline()
+        except GatewayTimeout:
+            # The other caller ran out of its own request's time, which says nothing about this one, so try again
+            return self(*args, **kwargs)
+
+    def __join_in_flight(self, key: Hashable):
+        # Returns the future for the call that fetches key, and whether the caller has to make that call
+        with self.__lock:
+            future = self.__in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self.__in_flight[key] = future
+            return future, True
+
+    def __fetch(self, key: Hashable, future: Future, args: tuple, kwargs: dict):
+        # Calls the function as the single caller for key, stores the result, and hands it to the waiting callers
+        try:
+            # Another caller may have stored a fresh value between the lookup and becoming the leader
+            found, entry = self.__backend.get(key)
+            if found and time.time() < entry[0]:
+                value = entry[1]
+            else:
+                self.__count("miss")
+                value = self.__function(*args, **kwargs)
+                self.__backend.set(key, (time.time() + self.__ttl, value))
+        except BaseException as e:
+            self.__finish(key, future, exception=e)
+            raise
+        self.__finish(key, future, value)
+        return value
+
+    def __finish(self, key: Hashable, future: Future, value=None, exception: Optional[BaseException] = None):
+        with self.__lock:
+            del self.__in_flight[key]
+        if exception is None:
+            future.set_result(value)
+        else:
+            future.set_exception(exception)
+
+    def __start_refresh(self, key: Hashable, args: tuple, kwargs: dict):
+        future, is_leader = self.__join_in_flight(key)
+        if is_leader:
+            _get_refresh_executor().submit(self.__refresh, key, future, args, kwargs)
+
+    def __refresh(self, key: Hashable, future: Future, args: tuple, kwargs: dict):
+        try:
+            self.__fetch(key, future, args, kwargs)
+        except Exception as e:
+            # The stale value stays until max_stale runs out, then callers block on a normal fetch again
+            logger.warning(f"Background refresh of {self.__name} failed: {e}")
+
+    def lookup(self, *args, **kwargs):
+        # Returns (True, value) if there is a usable entry for a call with these arguments and (False, None) otherwise
+        # For callers that fetch the value themselves, like the async Autolab client. A stale entry is returned and
+        # refreshed in the background like in a normal call.
+        key = self.__key(*args, **kwargs)
+        found, entry = self.__backend.get(key)
+        if not found:
+            return False, None
+        fresh_until, value = entry
+        if time.time() < fresh_until:
+            self.__count("hit")
+        else:
+            self.__count("stale")
+            self.__start_refresh(key, args, kwargs)
+        return True, value
+
+    def join(self, *args, **kwargs) -> Tuple[Future, bool]:
+        # For callers that fetch the value themselves, like the async Autolab client, after lookup found nothing
+        # Returns the future of the fetch in flight for a call with these arguments, and whether the caller has to
+        # make that fetch. If it does, it has to report the outcome with resolve, even if the fetch fails.
+        future, is_leader = self.__join_in_flight(self.__key(*args, **kwargs))
+        if not is_leader:
+            self.__count("coalesced")
+        return future, is_leader
+
+    def resolve(self, future: Future, value, exception: Optional[BaseException], *args, **kwargs):
+        # Stores the value fetched after join, or passes the exception on, and hands it to the waiting callers
+        key = self.__key(*args, **kwargs)
+        if exception is None:
+            self.__count("miss")
+            self.__backend.set(key, (time.time() + self.__ttl, value))
+        self.__finish(key, future, value, exception)
+
+    def cache_info(self) -> dict:
+        with self.__lock:
+            info = {"hits": self.__counts["hit"], "stale_hits": self.__counts["stale"],
+                    "misses": self.__counts["miss"], "coalesced": self.__counts["coalesced"]}
+        info.update({"size": self.__backend.size(), "maxsize": self.__maxsize})
+        return info
+
+    def cache_clear(self):
+        self.__backend.clear()
+
+
+def single_flight_ttl_cache(maxsize: int = 128, ttl: float = 600, method: bool = False, max_stale: float = 0):
+    # Decorator version of SingleFlightTTLCache, a drop-in replacement for cachetools.func.ttl_cache
+    # method: leave self out of the key, so entries can be shared by the same method across processes
+    # max_stale: seconds past ttl during which a stale entry is served while it is refreshed in the background
+
+    def decorator(function: Callable) -> Callable:
+        key = cachetools.keys.methodkey if method else cachetools.keys.hashkey
+        cache = SingleFlightTTLCache(function, maxsize, ttl, key, max_stale)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return cache(*args, **kwargs)
+
+        wrapper.cache_lookup = cache.lookup
+        wrapper.cache_join = cache.join
+        wrapper.cache_resolve = cache.resolve
+        wrapper.cache_info = cache.cache_info
+        wrapper.cache_clear = cache.cache_clear
+        return wrapper
+
+    return decorator
@@ -0,0 +1,232 @@
+import asyncio
+import concurrent.futures
+import logging
+import math
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, List, Optional
+
+import httpx
+from werkzeug.exceptions import GatewayTimeout
+
+from backend.connections.autolab_api_connection import AutolabApiConnection, upstream_unavailable_exception
+from backend.connections.conditional_requests import ValidatorStore
+from backend.connections.throttle import UpstreamUnavailable, parse_retry_after
+from backend.metrics import UPSTREAM_RETRY_AFTER
+from backend.request_deadline import abort_past_deadline, current_deadline, upstream_timeout
+from backend.upstream_timing import time_upstream, count_upstream_error, current_upstream_seconds
+
+logger = logging.getLogger("portal")
+
+# The deadline and g.upstream_seconds of the request that called run(), for the coroutines running on the event loop
+# thread, which has no request context. Set by run() for each coroutine it schedules, and inherited by its subtasks.
+_request_deadline: ContextVar[Optional[float]] = ContextVar("autolab_async_request_deadline", default=None)
+_upstream_seconds: ContextVar[Optional[Dict[str, float]]] = ContextVar("autolab_async_upstream_seconds", default=None)
+
+
+class AsyncAutolabApiConnection:
+    # An asyncio variant of AutolabApiConnection for handlers that need several independent Autolab calls
+    # Flask views stay synchronous: they build coroutines with the methods below and pass them to gather(), which runs
+    # them concurrently on an event loop owned by this object and blocks until all of them are done.
+    # The event loop runs in a background thread of each worker process, and holds one pooled httpx client.
+    # The cached lookups share their cache entries and in-flight fetches with the synchronous client, and the access
+    # token comes from its AutolabTokenManager. Anything that can block, like a token refresh or the SQLite cache
+    # backend, runs in the loop's default executor so it never holds up the event loop.
+
+    def __init__(self, autolab: AutolabApiConnection, pool_size: int = 10, timeout: float = 30):
+        self.__autolab = autolab
+        self.__path = autolab.path
+        self.__tokens = autolab.tokens
+        self.__validators = autolab.validators
+        self.__throttle = autolab.throttle
+        self.__pool_size = pool_size
+        self.__timeout = timeout
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__client: Optional[httpx.AsyncClient] = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def __get_loop(self) -> asyncio.AbstractEventLoop:
+        # Threads do not survive a fork, so every worker process starts its own event loop thread
+        with self.__lock:
+            if self.__pid != os.getpid():
+                self.__loop = asyncio.new_event_loop()
+                self.__client = None
+                self.__pid = os.getpid()
+                threading.Thread(target=self.__loop.run_forever, name="autolab-async", daemon=True).start()
+                # Creating the client loads the TLS certificates, which takes long enough to do ahead of the first call
+                self.__loop.call_soon_threadsafe(self.__get_client)
+            return self.__loop
+
+    def start(self):
+        # Starts the event loop and creates the client in the background. Optional, the first call does it otherwise.
+        self.__get_loop()
+
+    def __get_client(self) -> httpx.AsyncClient:
+        # Created on the event loop thread, which is the only thread that uses it
+        if self.__client is None:
+            limits = httpx.Limits(max_connections=self.__pool_size, max_keepalive_connections=self.__pool_size)
+            self.__client = httpx.AsyncClient(limits=limits, timeout=self.__timeout)
+        return self.__client
+
+    def run(self, coroutine: Awaitable) -> Any:
+        # Runs a coroutine on the event loop and blocks until it finishes, returning its result or raising its exception
+        # During a request, gives up when the request's deadline passes and aborts with 504
+        try:
+            # Before scheduling, so a request that is already past its deadline doesn't leave the coroutine running
+            timeout = upstream_timeout(self.__timeout)
+        except GatewayTimeout:
+            coroutine.close()
+            raise
+        future = asyncio.run_coroutine_threadsafe(
+            self.__run_for_request(coroutine, current_deadline(), current_upstream_seconds()), self.__get_loop())
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            if current_deadline() is None:
+                raise Exception("Autolab API request timed out.")
+            abort_past_deadline()
+
+    @staticmethod
+    async def __run_for_request(coroutine: Awaitable, deadline: Optional[float],
+                                upstream_seconds: Optional[Dict[str, float]]) -> Any:
+        # Runs in its own task, so these only apply to this coroutine and the tasks it starts
+        _request_deadline.set(deadline)
+        _upstream_seconds.set(upstream_seconds)
+        return await coroutine
+
+    def __upstream_timeout(self) -> float:
+        # Like upstream_timeout, using the deadline that run() passed in
+        deadline = _request_deadline.get()
+        if deadline is None:
+            return self.__timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            abort_past_deadline()
+        return min(self.__timeout, remaining)
+
+    def gather(self, *coroutines: Awaitable, return_exceptions: bool = False) -> List[Any]:
+        # Runs the coroutines concurrently and returns their results in order, like asyncio.gather
+        # Usable from synchronous code like Flask views, e.g.
+        #   user_courses, assessments = autolab_async.gather(autolab_async.user_courses(email),
+        #                                                    autolab_async.course_assessments(course_name))
+
+        async def gather_all():
+            return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+        return self.run(gather_all())
+
+    async def make_api_request(self, method: str, path: str, params: dict, json=None, retry: bool = False,
+                               deadline: Optional[float] = None) -> dict:
+        # Same behavior as AutolabApiConnection.make_api_request
+        url = f"{self.__path}{path}"
+        logger.debug(f"Making async API request to {method} {url} with params: {params} ({retry=})")
+        if deadline is None:
+            deadline = min(self.__throttle.default_deadline(), _request_deadline.get() or math.inf)
+        self.__upstream_timeout()  # Aborts before waiting for the throttle if the request is out of time
+        try:
+            await asyncio.sleep(self.__throttle.reserve(deadline))
+        except UpstreamUnavailable as e:
+            raise upstream_unavailable_exception(e, path)
+        timeout = self.__upstream_timeout()
+        validator_key = ValidatorStore.key(path, params) if method == "GET" else None
+        headers = self.__validators.request_headers(validator_key) if validator_key is not None else {}
+        # Usually only reads memory, but can fall back to a refresh, which takes a file lock and calls Autolab
+        access_token = await asyncio.get_running_loop().run_in_executor(None, self.__tokens.get_access_token)
+        try:
+            with time_upstream("autolab", path, _upstream_seconds.get()):
+                r = await self.__get_client().request(method, url, json=json, headers=headers, timeout=timeout,
+                                                      params={**params, "access_token": access_token})
+        except Exception as e:
+            self.__throttle.record_failure()
+            logger.error(str(e))
+            raise Exception("Failed to connect to Autolab API. Detailed information has been logged.")
+        if r.status_code >= 500:
+            self.__throttle.record_failure()
+        else:
+            self.__throttle.record_success()
+        if r.status_code == 304 and validator_key is not None:
+            body = self.__validators.revive(validator_key)
+            if body is None:
+                # Evicted since the request was sent, so there are no validators to send this time
+                return await self.make_api_request(method, path, params, json=json, retry=retry, deadline=deadline)
+            logger.debug(f"API request to {method} {url} was not modified, reusing the previous response")
+            return body
+        if r.status_code != 200:
+            logger.debug(f"API request failed with status code {r.status_code}")
+            count_upstream_error("autolab", path)
+            if r.status_code == 429:
+                self.__throttle.pause(max(0.25, parse_retry_after(r.headers.get("Retry-After"))))
+                UPSTREAM_RETRY_AFTER.labels("autolab").inc()
+                return await self.make_api_request(method, path, params, json=json, retry=retry, deadline=deadline)
+            if r.status_code == 401 and not retry:
+                logger.debug("Trying again after getting a new access token")
+                try:
+                    # Refreshing takes a file lock and may call Autolab, so keep it off the event loop
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, lambda: self.__tokens.refresh(failed_access_token=access_token))
+                except Exception as e:
+                    logger.error(str(e))
+                    raise Exception(
+                        "Failed to get API access token from Autolab. Detailed information has been logged.")
+                return await self.make_api_request(method, path, params, json=json, retry=True, deadline=deadline)
+            logger.error(f"API request failed with status code {r.status_code} ({retry=})")
+            message = "Response: " + r.text
+            logger.error(message)
+            raise Exception(message)
+        body = r.json()
+        if validator_key is not None:
+            self.__validators.remember(validator_key, r.headers, body)
+        return body
+
+    async def __cached_get(self, cached_method, path: str, params: dict, *args) -> dict:
+        # Uses the cache of the matching AutolabApiConnection method, so both clients share entries, and a miss that
+        # either client is already fetching waits for that fetch instead of making another call
+        loop = asyncio.get_running_loop()
+        found, value = await loop.run_in_executor(None, cached_method.cache_lookup, self.__autolab, *args)
+        if found:
+            return value
+        future, is_leader = cached_method.cache_join(self.__autolab, *args)
+        if not is_leader:
+            try:
+                # Shielded, so giving up on the wait doesn't cancel the fetch for everyone else waiting on it
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except GatewayTimeout:
+                # The fetching request ran out of its own time, which says nothing about this one, so try again
+                return await self.__cached_get(cached_method, path, params, *args)
+        try:
+            value = await self.make_api_request("GET", path, params)
+        except asyncio.CancelledError:
+            # run() gave up at its request's deadline. Other requests waiting for this fetch try again themselves.
+            cached_method.cache_resolve(future, None, GatewayTimeout(), self.__autolab, *args)
+            raise
+        except BaseException as e:
+            cached_method.cache_resolve(future, None, e, self.__autolab, *args)
+            raise
+        await loop.run_in_executor(None, cached_method.cache_resolve, future, value, None, self.__autolab, *args)
+        return value
+
+    async def user_courses(self, user_email: str) -> dict:
+        # See AutolabApiConnection.user_courses
+        return await self.__cached_get(AutolabApiConnection.user_courses, "/api/ubcseit/user_courses",
+                                       {"email": user_email}, user_email)
+
+    async def course_users(self, course_name: str) -> dict:
+        # See AutolabApiConnection.course_users
+        return await self.__cached_get(AutolabApiConnection.course_users, "/api/ubcseit/course_users",
+                                       {"course_name": course_name}, course_name)
+
+    async def course_assessments(self, course_name: str) -> dict:
+        # See AutolabApiConnection.course_assessments
+        return await self.__cached_get(AutolabApiConnection.course_assessments, "/api/ubcseit/course_assessments",
+                                       {"course_name": course_name}, course_name)
+
+    async def get_assessment_submissions(self, course_name: str, assessment_name: str) -> dict:
+        # See AutolabApiConnection.get_assessment_submissions
+        return await self.__cached_get(AutolabApiConnection.get_assessment_submissions,
+                                       "/api/ubcseit/assessment_submissions",
+                                       {"course_name": course_name, "assessment_name": assessment_name},
+                                       course_name, assessment_name)
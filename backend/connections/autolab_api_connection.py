@@ -1,12 +1,27 @@
 import logging
+import math
+import os
 import time
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterable, Optional
 
-import cachetools.func
-import requests
+from flask import copy_current_request_context, g, has_request_context
+from werkzeug.exceptions import GatewayTimeout
+
+from backend.caching import single_flight_ttl_cache
+from backend.connections.autolab_token_manager import AutolabTokenManager
+from backend.connections.conditional_requests import ValidatorStore
+from backend.connections.http_session import PooledHttpSession
+from backend.connections.throttle import UpstreamThrottle, UpstreamUnavailable, parse_retry_after
+from backend.metrics import UPSTREAM_THROTTLED, UPSTREAM_RETRY_AFTER, UPSTREAM_HEDGED
+from backend.request_deadline import current_deadline, upstream_timeout
+from backend.upstream_timing import time_upstream, count_upstream_error, current_upstream_seconds
 
 logger = logging.getLogger("portal")
 
+# Seconds past their TTL during which cached course lookups are served while being refreshed in the background
+AUTOLAB_CACHE_MAX_STALE = float(os.getenv("AUTOLAB_CACHE_MAX_STALE", 120))
+
 
 def store_refresh_token(refresh_token: str):
     with open("mount/refresh_token.txt", "w") as f:
@@ -21,6 +36,15 @@ def get_refresh_token_from_file() -> str:
         return ""
 
 
+def upstream_unavailable_exception(e: UpstreamUnavailable, path: str) -> Exception:
+    # Counts a call the throttle refused to make and returns the exception to raise for it
+    count_upstream_error("autolab", path)
+    UPSTREAM_THROTTLED.labels("autolab", str(e)).inc()
+    if str(e) == "circuit_open":
+        return Exception("Autolab is not responding. Try again in a minute.")
+    return Exception("Autolab API rate limit exceeded. Try again in a few seconds.")
+
+
 def get_start_and_end_dates_for_semester(semester: str) -> tuple:
     # semester is a string like "f23"
     # Return a tuple of strings like ("2024-08-20", "2024-12-20")
@@ -44,21 +68,47 @@ def get_start_and_end_dates_for_semester(semester: str) -> tuple:
 
 
 class AutolabApiConnection:
-    def __init__(self, path: str, client_id: str, client_secret: str, client_callback: str):
+    def __init__(self, path: str, client_id: str, client_secret: str, client_callback: str,
+                 pool_size: int = 10, retries: int = 2, token_refresh_margin: float = 300,
+                 throttle: Optional[UpstreamThrottle] = None, timeout: float = 30, hedge_after: float = 0):
+        # timeout: seconds to wait for Autolab to connect or send data, lowered to fit the current request's deadline
+        # hedge_after: seconds after which a GET that hasn't been answered is sent again, 0 to never hedge
         self.__path = path
         self.__client_id = client_id
         self.__client_secret = client_secret
         self.__client_callback = client_callback
-        self.__access_token = None
+        self.__http = PooledHttpSession(pool_size, retries)
+        self.__validators = ValidatorStore()
+        self.__throttle = throttle if throttle is not None else UpstreamThrottle()
+        self.__timeout = timeout
+        self.__hedge_after = hedge_after
+        self.__batch_concurrency = pool_size  # More threads than pooled connections would only wait for a connection
+        self.__tokens = AutolabTokenManager(self.__get_new_access_token, get_refresh_token_from_file,
+                                            store_refresh_token, refresh_margin=token_refresh_margin)
 
         if get_refresh_token_from_file() == "":
             logger.warning("No refresh token found, starting initial setup")
             self.__initial_setup()
-        self.__get_new_access_token()
+        self.__tokens.refresh()
+
+    @property
+    def path(self) -> str:
+        return self.__path
 
     @property
-    def __refresh_token(self):
-        return get_refresh_token_from_file()
+    def tokens(self) -> AutolabTokenManager:
+        # Shared with AsyncAutolabApiConnection so both clients use the same access token
+        return self.__tokens
+
+    @property
+    def throttle(self) -> UpstreamThrottle:
+        # Shared with AsyncAutolabApiConnection so the rate limit and circuit breaker cover both clients
+        return self.__throttle
+
+    @property
+    def validators(self) -> ValidatorStore:
+        # Shared with AsyncAutolabApiConnection so both clients can send conditional requests for the same responses
+        return self.__validators
 
     def __device_flow_init(self) -> dict:
         # Initiates the Ouath device flow
@@ -71,7 +121,7 @@ class AutolabApiConnection:
         params = {
             "client_id": self.__client_id,
         }
-        r = requests.request("GET", url, params=params)
+        r = self.__http.request("GET", url, params=params)
         return r.json()
 
     def __device_flow_authorize(self, device_code: str) -> dict:
@@ -87,7 +137,7 @@ class AutolabApiConnection:
         }
         while True:
             time.sleep(1)
-            r = requests.request("GET", url, params=params)
+            r = self.__http.request("GET", url, params=params)
             if "code" in r.json():
                 break
         return r.json()
@@ -109,12 +159,12 @@ class AutolabApiConnection:
             "redirect_uri": self.__client_callback
         }
         url = f"{self.__path}/oauth/token"
-        r = requests.request("POST", url, params=params)
+        r = self.__http.request("POST", url, params=params)
         return r.json()
 
-    def __get_new_access_token(self):
-        # Uses the refresh token stored on disk to get a new access token
-        # Updates self.__access_token token in memory
+    def __get_new_access_token(self, refresh_token: str) -> dict:
+        # Exchanges a refresh token for a new access token
+        # Only called by the token manager, which serializes refreshes across threads and workers
         # Returns a dict like:
         # {'access_token': 'abcd...
         #  'token_type': 'Bearer',
@@ -122,19 +172,19 @@ class AutolabApiConnection:
         #  'refresh_token': 'efgh...',
         #  'scope': 'user_info user_courses user_scores user_submit instructor_all admin_all',
         #  'created_at': 1686760138}
-        # Also updates the refresh token on disk with the new one received
-        #  - important because the old one is invalidated
-        logger.debug("Getting new access token")
+        # The token manager stores the new refresh token - important because the old one is invalidated
         url = f"{self.__path}/oauth/token"
         params = {
             "grant_type": "refresh_token",
-            "refresh_token": self.__refresh_token,
+            "refresh_token": refresh_token,
             "client_id": self.__client_id,
             "client_secret": self.__client_secret
         }
-        r = requests.request("POST", url, params=params)
-        self.__access_token = r.json()["access_token"]
-        store_refresh_token(r.json()["refresh_token"])
+        with time_upstream("autolab", "/oauth/token"):
+            r = self.__http.request("POST", url, params=params, timeout=self.__timeout)
+        if r.status_code != 200:
+            count_upstream_error("autolab", "/oauth/token")
+            raise Exception(f"Refreshing the Autolab access token failed with status code {r.status_code}: {r.text}")
         return r.json()
 
     def __initial_setup(self):
@@ -149,44 +199,97 @@ class AutolabApiConnection:
         store_refresh_token(initial_refresh_token_resp["refresh_token"])
         logger.info("Initial OAuth setup complete")
 
-    def make_api_request(self, method: str, path: str, params: dict, json=None, retry: bool = False) -> dict:
+    def __allow_hedge(self) -> bool:
+        # Hedged requests are optional, so they are only sent if the rate limit has room for them right now
+        if not self.__throttle.try_reserve():
+            return False
+        UPSTREAM_HEDGED.labels("autolab").inc()
+        return True
+
+    def make_api_request(self, method: str, path: str, params: dict, json=None, retry: bool = False,
+                         deadline: Optional[float] = None) -> dict:
         # Makes a request to the Autolab API
         # method: GET, POST, PUT, DELETE, etc.
         # path: relative path to endpoint including leading slash (e.g. "/api/v1/courses")
         # params: dict of params to pass to the endpoint, excluding the access token
         # json: optional body to send as JSON
         # retry: True if this is a retry after a failed request due to an expired access token
-        # Returns the response as a dict and handles refreshing the access token if needed
+        # deadline: time.monotonic() value by which the request has to be sent, including time queued by the throttle
+        #  and waiting out 429 responses. Defaults to the throttle's max_wait from now, or the current request's
+        #  deadline if that is sooner.
+        # Returns the response as a dict and handles refreshing the access token if Autolab rejects it
+        # GET requests are conditional when an earlier response had an ETag or Last-Modified header, and a 304 Not
+        # Modified response returns the body remembered from then
         # Raises an exception if the request fails even after refreshing the access token
         url = f"{self.__path}{path}"
         logger.debug(f"Making API request to {method} {url} with params: {params} ({retry=})")
-        params["access_token"] = self.__access_token
+        if deadline is None:
+            deadline = min(self.__throttle.default_deadline(), current_deadline() or math.inf)
+        upstream_timeout(self.__timeout)  # Aborts right away if the request is already out of time
+        try:
+            time.sleep(self.__throttle.reserve(deadline))
+        except UpstreamUnavailable as e:
+            raise upstream_unavailable_exception(e, path)
+        timeout = upstream_timeout(self.__timeout)
+        validator_key = ValidatorStore.key(path, params) if method == "GET" else None
+        headers = self.__validators.request_headers(validator_key) if validator_key is not None else {}
+        access_token = self.__tokens.get_access_token()
+        params["access_token"] = access_token
         try:
-            r = requests.request(method, url, json=json, params=params)
+            with time_upstream("autolab", path):
+                if method == "GET" and 0 < self.__hedge_after < timeout:
+                    r = self.__http.hedged_get(url, self.__hedge_after, self.__allow_hedge, params=params,
+                                               headers=headers, timeout=timeout)
+                else:
+                    r = self.__http.request(method, url, json=json, params=params, headers=headers, timeout=timeout)
         except Exception as e:
+            self.__throttle.record_failure()
             logger.error(str(e))
             raise Exception("Failed to connect to Autolab API. Detailed information has been logged.")
+        if r.status_code >= 500:
+            self.__throttle.record_failure()
+        else:
+            self.__throttle.record_success()
+        if r.status_code == 304 and validator_key is not None:
+            body = self.__validators.revive(validator_key)
+            del params["access_token"]
+            if body is None:
+                # Evicted since the request was sent, so there are no validators to send this time
+                return self.make_api_request(method, path, params, json=json, retry=retry, deadline=deadline)
+            logger.debug(f"API request to {method} {url} was not modified, reusing the previous response")
+            return body
         if r.status_code != 200:
             logger.debug(f"API request failed with status code {r.status_code}")
+            count_upstream_error("autolab", path)
             if r.status_code == 429:
-                raise Exception("Autolab API rate limit exceeded. Try again in a few seconds.")
-            if not retry:
+                # Every caller waits for Retry-After, and this one tries again if that still fits its deadline
+                # The minimum keeps a Retry-After of 0 from turning into a burst of retries
+                self.__throttle.pause(max(0.25, parse_retry_after(r.headers.get("Retry-After"))))
+                UPSTREAM_RETRY_AFTER.labels("autolab").inc()
+                del params["access_token"]
+                return self.make_api_request(method, path, params, json=json, retry=retry, deadline=deadline)
+            if r.status_code == 401 and not retry:
                 logger.debug("Trying again after getting a new access token")
                 try:
-                    self.__get_new_access_token()
+                    # Only refreshes if no other worker has replaced the rejected token already
+                    self.__tokens.refresh(failed_access_token=access_token)
                 except Exception as e:
                     logger.error(str(e))
                     raise Exception(
                         "Failed to get API access token from Autolab. Detailed information has been logged.")
                 del params["access_token"]
-                return self.make_api_request(method, path, params, json=json, retry=True)
-            logger.error(f"API request failed even after getting a new access token with status code {r.status_code}")
+                return self.make_api_request(method, path, params, json=json, retry=True, deadline=deadline)
+            logger.error(f"API request failed with status code {r.status_code} ({retry=})")
             message = "Response: " + r.text
             logger.error(message)
             raise Exception(message)
         else:
-            logger.debug(f"API request succeeded. Returned {r.json()}")
-            return r.json()
+            body = r.json()
+            if validator_key is not None:
+                self.__validators.remember(validator_key, r.headers, body)
+            if logger.isEnabledFor(logging.DEBUG):  # Formatting a large roster is expensive
+                logger.debug(f"API request succeeded. Returned {body}")
+            return body
 
     def create_course(self, course_name: str, display_name: str, semester: str, instructor_email: str,
                       start_date: str, end_date: str) -> dict:
@@ -215,7 +318,7 @@ class AutolabApiConnection:
         }
         return self.make_api_request("GET", "/api/ubcseit/admin_check", params).get("is_administrator", False)
 
-    @cachetools.func.ttl_cache(maxsize=100, ttl=20)
+    @single_flight_ttl_cache(maxsize=100, ttl=20, method=True, max_stale=AUTOLAB_CACHE_MAX_STALE)
     def user_courses(self, user_email: str) -> dict:
         # Returns a dict like:
         # {
@@ -236,7 +339,7 @@ class AutolabApiConnection:
         }
         return self.make_api_request("GET", "/api/ubcseit/user_courses", params)
 
-    @cachetools.func.ttl_cache(maxsize=100, ttl=20)
+    @single_flight_ttl_cache(maxsize=100, ttl=20, method=True, max_stale=AUTOLAB_CACHE_MAX_STALE)
     def course_users(self, course_name: str) -> dict:
         # Returns a dict like:
         # {
@@ -257,7 +360,7 @@ class AutolabApiConnection:
         }
         return self.make_api_request("GET", "/api/ubcseit/course_users", params)
 
-    @cachetools.func.ttl_cache(maxsize=100, ttl=20)
+    @single_flight_ttl_cache(maxsize=100, ttl=20, method=True, max_stale=AUTOLAB_CACHE_MAX_STALE)
     def course_assessments(self, course_name: str) -> dict:
         # Returns a dict like:
         # {
@@ -278,7 +381,58 @@ class AutolabApiConnection:
         }
         return self.make_api_request("GET", "/api/ubcseit/course_assessments", params)
 
-    @cachetools.func.ttl_cache(maxsize=100, ttl=10)
+    def __fetch_many(self, cached_method, course_names: Iterable[str]) -> Dict[str, Optional[dict]]:
+        # Calls a cached single-course method for each distinct course name
+        # Cached entries are used directly and the rest are fetched concurrently, at most one per pooled connection
+        # Returns a dict of course name -> result, with None for courses whose fetch failed
+        results: Dict[str, Optional[dict]] = {}
+        missing: List[str] = []
+        for course_name in dict.fromkeys(course_names):  # Deduplicates while keeping the order
+            found, value = cached_method.cache_lookup(self, course_name)
+            if found:
+                results[course_name] = value
+            else:
+                missing.append(course_name)
+        if len(missing) == 0:
+            return results
+
+        in_request = has_request_context()
+        deadline, upstream_seconds = current_deadline(), current_upstream_seconds()
+
+        def fetch(course_name: str) -> dict:
+            if in_request:
+                # The copy of the request context doesn't include g, so the request's deadline and upstream time are
+                # passed in
+                g.deadline = deadline
+                g.upstream_seconds = upstream_seconds
+            return cached_method(self, course_name)
+
+        with ThreadPoolExecutor(max_workers=min(self.__batch_concurrency, len(missing))) as executor:
+            # A copy of the request context can only be active on one thread at a time, so each course gets its own
+            futures = {course_name: executor.submit(copy_current_request_context(fetch) if in_request else fetch,
+                                                    course_name)
+                       for course_name in missing}
+        for course_name, future in futures.items():
+            try:
+                results[course_name] = future.result()
+            except GatewayTimeout:
+                raise  # The request is out of time, so the other courses can't be shown either
+            except Exception as e:
+                logger.error(f"Batch {cached_method.__name__} failed for course {course_name}: {e}")
+                results[course_name] = None
+        return results
+
+    def course_users_many(self, course_names: Iterable[str]) -> Dict[str, Optional[dict]]:
+        # Like course_users for several courses at once
+        # Returns a dict of course name -> course_users response, or None if it could not be fetched
+        return self.__fetch_many(AutolabApiConnection.course_users, course_names)
+
+    def course_assessments_many(self, course_names: Iterable[str]) -> Dict[str, Optional[dict]]:
+        # Like course_assessments for several courses at once
+        # Returns a dict of course name -> course_assessments response, or None if it could not be fetched
+        return self.__fetch_many(AutolabApiConnection.course_assessments, course_names)
+
+    @single_flight_ttl_cache(maxsize=100, ttl=10, method=True)
     def get_assessment_submissions(self, course_name: str, assessment_name: str) -> dict:
         # Returns a dict like:
         # {
@@ -0,0 +1,127 @@
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+from backend.utils import write_file_atomically
+
+logger = logging.getLogger("portal")
+
+
+class AutolabTokenManager:
+    # Keeps a valid Autolab access token available to every gunicorn worker
+    # The current access token and its expiration time are shared through a JSON state file. Refreshes are
+    # serialized across processes with an exclusive flock on a separate lock file, and a worker that gets the lock
+    # after another worker already refreshed adopts the new token instead of refreshing again.
+    # This matters because Autolab rotates refresh tokens: two workers refreshing with the same refresh token would
+    # invalidate each other.
+    # A background thread refreshes refresh_margin seconds before the token expires, so in steady state requests
+    # only read the token from memory and never wait for a refresh.
+
+    def __init__(self, fetch_token: Callable[[str], dict], load_refresh_token: Callable[[], str],
+                 store_refresh_token: Callable[[str], None], state_path: str = "mount/autolab_token.json",
+                 lock_path: str = "mount/autolab_token.lock", refresh_margin: float = 300):
+        # fetch_token: exchanges a refresh token for a token response dict (access_token, expires_in, refresh_token)
+        # load_refresh_token/store_refresh_token: read and write the refresh token file, only used while refreshing
+        self.__fetch_token = fetch_token
+        self.__load_refresh_token = load_refresh_token
+        self.__store_refresh_token = store_refresh_token
+        self.__state_path = state_path
+        self.__lock_path = lock_path
+        self.__refresh_margin = refresh_margin
+        self.__state = None
+        self.__thread_lock = threading.Lock()
+        self.__refresher_lock = threading.Lock()
+        self.__thread = None
+        self.__pid = None
+
+    def __read_shared_state(self) -> Optional[dict]:
+        try:
+            with open(self.__state_path, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not {"access_token", "expires_at"} <= state.keys():
+            return None
+        return state
+
+    def __write_shared_state(self, state: dict):
+        # Only this user may read it, since it holds the access token
+        write_file_atomically(self.__state_path, json.dumps(state).encode("utf-8"), 0o600)
+
+    def __is_fresh(self, state: Optional[dict]) -> bool:
+        return state is not None and state["expires_at"] - self.__refresh_margin > time.time()
+
+    def refresh(self, failed_access_token: Optional[str] = None) -> str:
+        # Makes sure a fresh access token is loaded and returns it
+        # If another worker already refreshed, its token is adopted without contacting Autolab
+        # failed_access_token: a token Autolab rejected; it is replaced even if it does not look expired yet
+        with self.__thread_lock:
+            state = self.__state
+            if self.__is_fresh(state) and state["access_token"] != failed_access_token:
+                return state["access_token"]
+            with open(self.__lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    state = self.__read_shared_state()
+                    if self.__is_fresh(state) and state["access_token"] != failed_access_token:
+                        logger.debug("Adopting Autolab access token refreshed by another worker")
+                    else:
+                        state = self.__refresh_locked()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self.__state = state
+            return state["access_token"]
+
+    def __refresh_locked(self) -> dict:
+        # Must be called with the file lock held, which also makes the refresh token file safe to read and rotate
+        logger.debug("Getting new Autolab access token")
+        token_response = self.__fetch_token(self.__load_refresh_token())
+        self.__store_refresh_token(token_response["refresh_token"])
+        state = {
+            "access_token": token_response["access_token"],
+            "expires_at": time.time() + float(token_response.get("expires_in", 7200)),
+        }
+        self.__write_shared_state(state)
+        return state
+
+    def get_access_token(self) -> str:
+        # Returns the current access token from memory
+        # Only refreshes on the calling thread if the background refresh has fallen behind
+        self.__ensure_refresher()
+        state = self.__state
+        if state is not None and state["expires_at"] > time.time():
+            return state["access_token"]
+        return self.refresh()
+
+    def __ensure_refresher(self):
+        # A forked worker doesn't inherit the parent's refresher thread, so it starts one the first time it's used
+        if self.__pid == os.getpid():
+            return
+        with self.__refresher_lock:
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            self.__thread = threading.Thread(target=self.__run, name="autolab-token-refresher", daemon=True)
+            self.__thread.start()
+
+    def __seconds_until_refresh(self) -> float:
+        state = self.__state
+        if state is None:
+            return 0
+        # Jitter spreads the wakeups of different workers so most of them find an already refreshed token
+        jitter = random.uniform(0, min(30.0, self.__refresh_margin / 4))
+        return max(5.0, state["expires_at"] - self.__refresh_margin - time.time() + jitter)
+
+    def __run(self):
+        while True:
+            time.sleep(self.__seconds_until_refresh())
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Background Autolab access token refresh failed: {e}")
+                time.sleep(30)
@@ -0,0 +1,50 @@
+import threading
+from typing import Dict, Hashable, Optional
+
+import cachetools
+
+
+class ValidatorStore:
+    # Remembers the ETag and Last-Modified validators of GET responses, with the decoded body they belong to
+    # A later GET for the same URL and parameters sends them as If-None-Match / If-Modified-Since, and when the server
+    # answers 304 Not Modified the remembered body is used instead of downloading and decoding it again.
+    # Bounded by a least recently used cache, since bodies like course rosters can be large.
+
+    def __init__(self, maxsize: int = 256):
+        self.__entries = cachetools.LRUCache(maxsize=maxsize)
+        self.__lock = threading.Lock()  # cachetools caches aren't thread-safe
+
+    @staticmethod
+    def key(path: str, params: dict) -> Hashable:
+        # params must not include the access token, which changes without the response changing
+        return path, tuple(sorted(params.items()))
+
+    def request_headers(self, key: Hashable) -> Dict[str, str]:
+        # Returns the conditional request headers for key, or no headers if nothing is remembered
+        with self.__lock:
+            entry = self.__entries.get(key)
+        if entry is None:
+            return {}
+        etag, last_modified, _ = entry
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def remember(self, key: Hashable, response_headers, body: dict):
+        # Stores the validators of a 200 response, if it has any
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+        with self.__lock:
+            if etag is None and last_modified is None:
+                self.__entries.pop(key, None)
+            else:
+                self.__entries[key] = (etag, last_modified, body)
+
+    def revive(self, key: Hashable) -> Optional[dict]:
+        # Returns the remembered body for a 304 response, or None if it has been evicted since the request was sent
+        with self.__lock:
+            entry = self.__entries.get(key)
+        return None if entry is None else entry[2]
@@ -0,0 +1,156 @@
+import concurrent.futures
+import math
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.retry import Retry
+
+from backend.request_deadline import abort_past_deadline, upstream_timeout
+
+
+# Responses to idempotent requests that are retried, since they usually mean the upstream is briefly overloaded
+RETRY_STATUSES = (502, 503, 504)
+
+
+class PooledHttpSession:
+    # A requests.Session that keeps connections to an upstream server alive and reuses them, so repeated calls skip
+    # the TCP and TLS handshakes. A session can't be shared across a fork because the child would share the parent's
+    # sockets, so each process creates its own on first use.
+    #
+    # Connection failures are retried `retries` times with exponential backoff. So are 502, 503, and 504 responses to
+    # idempotent requests. Other error responses are returned to the caller as usual. A Retry-After header is not
+    # waited for here, the caller's UpstreamThrottle honors it without holding up the thread.
+    # The retries are made here rather than by urllib3, so that during a request every attempt's timeout is cut to
+    # what is left of the request's deadline, and no retry is started once there isn't time for it.
+
+    def __init__(self, pool_size: int, retries: int, backoff_factor: float = 0.2):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.__session = None
+        self.__executor = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<PooledHttpSession pool size {self.pool_size} with {self.retries} retries>"
+
+    def __create_session(self) -> requests.Session:
+        # pool_maxsize is per host. There's only one upstream host per session, so pool_connections can stay small.
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size, max_retries=0)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    self.__session = self.__create_session()
+                    self.__executor = None
+                    self.__pid = os.getpid()
+        return self.__session
+
+    @property
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # Threads for hedges and concurrent requests, at most one per pooled connection
+        self.session  # Replaces the executor of a parent process after a fork
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.pool_size,
+                                                                        thread_name_prefix="http")
+            return self.__executor
+
+    def request(self, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            if attempt > 0:
+                backoff = self.__backoff(attempt)
+                remaining = self.__wait_timeout()
+                if remaining is not None and remaining <= backoff:
+                    last_attempt = True  # No time to wait and try again, so this attempt's outcome is final
+                else:
+                    time.sleep(backoff)
+            try:
+                response = self.session.request(method, url, timeout=self.__attempt_timeout(timeout), **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if last_attempt or not self.__not_sent(e):
+                    raise
+                continue
+            if last_attempt or response.status_code not in RETRY_STATUSES or \
+                    method.upper() not in Retry.DEFAULT_ALLOWED_METHODS:
+                return response
+            response.close()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def __backoff(self, attempt: int) -> float:
+        # Like urllib3: the first retry is immediate, then the wait doubles
+        return 0 if attempt <= 1 else self.backoff_factor * 2 ** (attempt - 1)
+
+    def __attempt_timeout(self, timeout: Optional[float]) -> Optional[float]:
+        # The caller's timeout, or less if the request's deadline is closer. Aborts with 504 if it has passed.
+        remaining = self.__wait_timeout()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    @staticmethod
+    def __not_sent(e: requests.exceptions.ConnectionError) -> bool:
+        # Whether the connection failed before the request was sent, which makes it safe to send again for any method
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(e, requests.exceptions.ConnectTimeout) or isinstance(reason, ConnectTimeoutError)
+
+    def hedged_get(self, url: str, hedge_after: float, allow_hedge: Callable[[], bool] = lambda: True,
+                   **kwargs) -> requests.Response:
+        # Sends the same GET again if the first one hasn't been answered after hedge_after seconds, and returns the
+        # response that arrives first. This cuts tail latency when a single connection or server thread stalls.
+        # Only for idempotent requests. allow_hedge is called before sending the second request and can veto it, for
+        # example when the upstream's rate limit has no room for it.
+        # A response that arrives second is discarded, and its connection goes back to the pool.
+        # The first request gets a thread of its own, so it is sent right away even when the executor is busy. Only
+        # the hedge waits for the executor. During a request, waiting stops at the request's deadline with a 504.
+        first = self.__start_get(url, kwargs)
+        try:
+            return first.result(timeout=hedge_after)
+        except concurrent.futures.TimeoutError:
+            pass
+        pending = {first}
+        if allow_hedge():
+            pending.add(self.executor.submit(self.get, url, **kwargs))
+        while True:
+            done, pending = concurrent.futures.wait(pending, timeout=self.__wait_timeout(),
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if len(done) == 0:
+                abort_past_deadline()
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            if len(pending) == 0:
+                return done.pop().result()  # Every request failed, so raise one of the exceptions
+
+    def __start_get(self, url: str, kwargs: dict) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+
+        def get():
+            try:
+                future.set_result(self.get(url, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=get, name="http-first", daemon=True).start()
+        return future
+
+    @staticmethod
+    def __wait_timeout() -> Optional[float]:
+        # The time left before the current request's deadline, or None to wait for the requests' own timeouts
+        timeout = upstream_timeout(math.inf)
+        return None if timeout == math.inf else timeout
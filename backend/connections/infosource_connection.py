@@ -1,36 +1,46 @@
 import logging
+import os
+import threading
 from typing import List, Dict, Any
 
-import cachetools.func
 import oracledb
 
+from backend.caching import single_flight_ttl_cache
 from backend.connections.course import Course
+from backend.request_deadline import upstream_timeout
+from backend.upstream_timing import time_upstream
 from backend.utils import twelve_hour_time_to_24_hour_time, class_meeting_pattern_source_key_to_days_code
 
 logger = logging.getLogger("portal")
 
+# Seconds past their TTL during which cached section lookups are served while being refreshed in the background
+INFOSOURCE_CACHE_MAX_STALE = float(os.getenv("INFOSOURCE_CACHE_MAX_STALE", 3600))
+
 
 class InfoSourceConnection:
-    def __init__(self, username: str, password: str, dsn: str):
+    def __init__(self, username: str, password: str, dsn: str, call_timeout: float = 30):
+        # call_timeout: seconds any single database round trip may take, lowered to fit the current request's deadline
         logger.debug(f"Connecting to InfoSource database {dsn} as {username}")
         self.username = username
         self.password = password
         self.dsn = dsn
-        self.con = None
-        self.cursor = None
+        self.call_timeout = call_timeout
+        # One instance is shared by every request thread, so each thread needs its own connection and cursor
+        self.__local = threading.local()
         oracledb.init_oracle_client()
         logger.debug("Successfully connected to InfoSource database")
 
     def __enter__(self):
-        self.con = oracledb.connect(user=self.username, password=self.password, dsn=self.dsn)
-        self.cursor = self.con.cursor()
-        return self.cursor
+        self.__local.con = oracledb.connect(user=self.username, password=self.password, dsn=self.dsn)
+        self.__local.con.call_timeout = int(upstream_timeout(self.call_timeout) * 1000)  # In milliseconds
+        self.__local.cursor = self.__local.con.cursor()
+        return self.__local.cursor
 
     def __exit__(self, *args):
-        self.cursor.close()
-        self.con.close()
-        self.cursor = None
-        self.con = None
+        self.__local.cursor.close()
+        self.__local.con.close()
+        self.__local.cursor = None
+        self.__local.con = None
 
     def query_all_courses(self) -> List[Course]:
         logger.debug("Querying all courses from InfoSource database")
@@ -63,14 +73,14 @@ class InfoSourceConnection:
             ORDER BY ENDDATE, COURSENUMBER
               """
 
-        with self as info:
+        with time_upstream("infosource", "query_all_courses"), self as info:
             info.execute(stmt)
             # Put the results into a Course based on https://stackoverflow.com/a/57108771
             info.rowfactory = lambda *args: Course(*args)
             rows = info.fetchall()
             return rows
 
-    @cachetools.func.ttl_cache(maxsize=10, ttl=600)
+    @single_flight_ttl_cache(maxsize=10, ttl=600, method=True, max_stale=INFOSOURCE_CACHE_MAX_STALE)
     def get_course_sections_by_autolab_course_name(self, autolab_course_name: str):
         # autolab_course_name will be like "cse116-f21" or "cse442-u23b"
 
@@ -100,7 +110,7 @@ class InfoSourceConnection:
               AND TERM = :term
         """
 
-        with self as info:
+        with time_upstream("infosource", "get_course_sections_by_autolab_course_name"), self as info:
             info.execute(stmt, subject=subject, course_number=f"{course_number}%", term=f"{season} {year}")
             rows = info.fetchall()
             # This looks like: [
@@ -134,7 +144,7 @@ class InfoSourceConnection:
                  JOIN PS_RPT.UB_DISPLAY_NAME_V ON DCE.PERSON_NUMBER.PERSON_NUMBER = PS_RPT.UB_DISPLAY_NAME_V.EMPLID
             WHERE PRINCIPAL = :username
         """
-        with self as info:
+        with time_upstream("infosource", "get_person_info_by_username"), self as info:
             info.execute(stmt, username=username)
             # Based on https://stackoverflow.com/a/57108771
             info.rowfactory = lambda *args: dict(zip([d[0] for d in info.description], args))
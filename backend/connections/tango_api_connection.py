@@ -1,75 +1,127 @@
+import bisect
 import datetime
 import logging
 import math
-import threading
-from typing import List, Dict
+import time
+from array import array
+from typing import List, Dict, Iterable, NamedTuple, Optional, Sequence
 
-import requests
+from backend.connections.http_session import PooledHttpSession
+from backend.tango_time_series import TangoTimeSeries
+from backend.upstream_timing import time_upstream, count_upstream_error
 
 logger = logging.getLogger("portal")
 
+# Windows of the default cumulative histogram, in seconds
+DEFAULT_SAMPLE_SECONDS = [1, 2, 3, 5, 10, 15, 20, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 28800, 57600, 86400,
+                          172800, 259200, 345600, 432000, 518400, 604800, 1209600, 2592000]
+
+
+class TangoSnapshot(NamedTuple):
+    # Sorted start times (Unix timestamps) of the jobs Tango reported at taken_at, and their counts over time
+    # Snapshots are shared by all threads, so they are replaced as a whole and never modified
+    taken_at: float
+    start_times: array
+    series: TangoTimeSeries
+
 
 class TangoApiConnection:
+    # Request handlers only read the latest snapshot, which TangoPoller publishes. Nothing here contacts Tango during
+    # a request.
 
-    def __init__(self, tango_host: str, tango_key: str, tango_max_poll_rate: float):
+    def __init__(self, tango_host: str, tango_key: str, pool_size: int = 4, timeout: float = 5):
+        # timeout: seconds to wait for Tango to connect or send data
         self.__tango_host = tango_host
         self.__tango_key = tango_key
-        self.__tango_max_poll_rate = tango_max_poll_rate
-        self.last_fetch_time = datetime.datetime(1970, 1, 1)
-        self.raw_data_cache = {}
-        self.update_lock = threading.Lock()
+        self.raw_data_cache = {}  # Last good copy of each job list, kept for when fetching one of them fails
+        self.__http = PooledHttpSession(pool_size, retries=1)
+        self.__timeout = timeout
+        self.snapshot = TangoSnapshot(0.0, array("d"), TangoTimeSeries())
 
     def __get_raw_job_data(self) -> dict:
         # This data contains sensitive information, such as email addresses and the Tango API key.
         # Don't share the raw data.
-        with self.update_lock:
-            if self.last_fetch_time + datetime.timedelta(seconds=self.__tango_max_poll_rate) < datetime.datetime.now():
-                self.last_fetch_time = datetime.datetime.now()
-                self.raw_data_cache["dead_jobs"] = \
-                    requests.get(f"{self.__tango_host}/jobs/{self.__tango_key}/1/").json()
-                self.raw_data_cache["current_jobs"] = \
-                    requests.get(f"{self.__tango_host}/jobs/{self.__tango_key}/0/").json()
+        # Replace the whole dict so dead and current jobs always come from the same fetch, or its last good copy
+        self.raw_data_cache = self.__fetch_raw_job_data(self.raw_data_cache)
         return self.raw_data_cache
 
-    def __get_combined_jobs(self) -> List[dict]:
-        # Return a list of running and finished ("dead") jobs
+    def __fetch_raw_job_data(self, previous: dict) -> dict:
+        # Fetches the dead and current job lists at the same time, so a refresh takes one round trip instead of two
+        # If one of them fails, the previous copy of that list is kept. If there is no previous copy, this raises.
+        urls = {
+            "dead_jobs": f"{self.__tango_host}/jobs/{self.__tango_key}/1/",
+            "current_jobs": f"{self.__tango_host}/jobs/{self.__tango_key}/0/",
+        }
+        with time_upstream("tango", "/jobs/"):
+            futures = {name: self.__http.executor.submit(self.__fetch_jobs, url) for name, url in urls.items()}
+            data = {}
+            for name, future in futures.items():
+                try:
+                    data[name] = future.result()
+                except Exception as e:
+                    if name not in previous:
+                        raise
+                    # Only log the type, the message can contain the URL with the Tango key
+                    logger.warning(f"Couldn't fetch {name} from Tango ({type(e).__name__}), keeping the last copy")
+                    count_upstream_error("tango", "/jobs/")
+                    data[name] = previous[name]
+        return data
+
+    def __fetch_jobs(self, url: str) -> dict:
+        response = self.__http.get(url, timeout=self.__timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_jobs(self) -> List[dict]:
+        # Fetches and returns the running and finished ("dead") jobs from Tango. This takes a round trip to Tango, so
+        # only TangoPoller calls it.
         # This still contains sensitive information.
         data = self.__get_raw_job_data()
         return data.get("dead_jobs").get("jobs") + data.get("current_jobs").get("jobs")
 
-    def get_recent_submission_times(self) -> List[datetime.datetime]:
-        jobs: List[dict] = self.__get_combined_jobs()
-        job: dict
-        start_times: List[datetime.datetime] = []
-        for job in jobs:
-            try:
-                date_string = job.get("trace")[0].split("|")[0].strip()
-                # Parse the date in this format: Sun Jul  9 20:57:31 2023
-                date: datetime.datetime = datetime.datetime.strptime(date_string, "%a %b %d %H:%M:%S %Y") \
-                    .replace(tzinfo=datetime.timezone.utc)
-                start_times.append(date)
-            except Exception:
-                pass  # Just ignore this job. I don't know why it wouldn't have an entry, but it's not important.
-        return start_times
-
-    def get_recent_submissions_histogram(self) -> Dict[int, int]:
-        # Return a dict of seconds to number of submissions within the past key seconds
-        # It's technically a cumulative histogram, not a regular one.
-
-        submission_dates = self.get_recent_submission_times()
-        now = datetime.datetime.now(tz=datetime.timezone.utc)
-        sample_seconds = [1, 2, 3, 5, 10, 15, 20, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 28800, 57600, 86400,
-                          172800, 259200, 345600, 432000, 518400, 604800, 1209600, 2592000]
+    @staticmethod
+    def trace_date_string(job: dict) -> Optional[str]:
+        # Returns the date at which a job was submitted as Tango wrote it, like Sun Jul  9 20:57:31 2023
+        # Runs of spaces are collapsed, so equal dates always give equal strings
+        try:
+            return " ".join(job.get("trace")[0].split("|")[0].split())
+        except Exception:
+            return None  # Just ignore this job. I don't know why it wouldn't have an entry, but it's not important.
 
-        histogram: Dict[int, int] = {k: 0 for k in sample_seconds}
+    @staticmethod
+    def parse_date_string(date_string: str) -> Optional[float]:
+        # Returns the Unix timestamp of a date from trace_date_string, or None if it isn't a date
+        try:
+            return datetime.datetime.strptime(date_string, "%a %b %d %H:%M:%S %Y") \
+                .replace(tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            return None
+
+    def get_submission_timestamps(self) -> Sequence[float]:
+        # Returns the sorted start timestamps of all jobs in the latest snapshot
+        return self.snapshot.start_times
 
-        for date in submission_dates:
-            seconds_ago: float = (now - date).total_seconds()
-            for seconds in sample_seconds:
-                if seconds_ago < seconds:
-                    histogram[seconds] += 1
+    def get_recent_submission_times(self) -> List[datetime.datetime]:
+        return [datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc) for t in self.get_submission_timestamps()]
 
-        return histogram
+    def get_recent_submissions_histogram(self, sample_seconds: Iterable[int] = DEFAULT_SAMPLE_SECONDS) \
+            -> Dict[int, int]:
+        # Return a dict of seconds to number of submissions within the past key seconds
+        # It's technically a cumulative histogram, not a regular one.
+        # Each window is a binary search, so any number of windows costs about the same as the default ones.
+        times = self.get_submission_timestamps()
+        now = time.time()
+        return {seconds: len(times) - bisect.bisect_right(times, now - seconds) for seconds in sample_seconds}
+
+    def get_submission_time_series(self, step: int) -> Dict[str, any]:
+        # Return the number of submissions per minute over the past day (step 60) or per hour over the past 30 days
+        # (step 3600), read from fixed-size buffers instead of counted from the jobs
+        start, counts = self.snapshot.series.counts(step, time.time())
+        return {
+            "step": step,
+            "start": start,
+            "counts": counts,
+        }
 
     @staticmethod
     def annotate_time_histogram(histogram: Dict[int, int]) -> Dict[int, Dict[str, any]]:
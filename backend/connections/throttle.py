@@ -0,0 +1,114 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class UpstreamUnavailable(Exception):
+    # Raised by UpstreamThrottle.reserve when a call can't be made before its deadline or the circuit is open
+    # The message is the reason, "rate_limited" or "circuit_open"
+    pass
+
+
+class UpstreamThrottle:
+    # Client-side rate limiting and circuit breaking for one upstream service, shared by all threads of a worker
+    # Rate limiting is a token bucket: up to `burst` calls can go out at once, then `rate` calls per second. Callers
+    # that find the bucket empty queue for their turn instead of failing, as long as their turn comes before their
+    # deadline. A Retry-After from the upstream pauses every caller until it has passed.
+    # The circuit breaker opens after `failure_threshold` consecutive failures (connection errors and 5xx responses).
+    # While it is open, calls fail immediately instead of piling up on a service that is down. After `open_seconds`
+    # one trial call is let through, and its outcome closes the circuit or opens it again.
+
+    def __init__(self, rate: float = 20, burst: int = 20, failure_threshold: int = 5, open_seconds: float = 30,
+                 max_wait: float = 5):
+        # max_wait: how long callers queue by default, see default_deadline
+        self.max_wait = max_wait
+        self.__rate = rate
+        self.__burst = burst
+        self.__failure_threshold = failure_threshold
+        self.__open_seconds = open_seconds
+        self.__lock = threading.Lock()
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__paused_until = 0.0
+        self.__consecutive_failures = 0
+        self.__open_until: Optional[float] = None  # None while the circuit is closed
+
+    def default_deadline(self) -> float:
+        return time.monotonic() + self.max_wait
+
+    def reserve(self, deadline: float) -> float:
+        # Takes a slot for one call and returns how many seconds the caller has to wait before making it
+        # deadline: time.monotonic() value by which the call has to start
+        # Raises UpstreamUnavailable if the circuit is open or the slot would come after the deadline
+        with self.__lock:
+            now = time.monotonic()
+            if self.__open_until is not None:
+                if now < self.__open_until:
+                    raise UpstreamUnavailable("circuit_open")
+                # Half open: this call is the trial, and the circuit stays open for everyone else until it reports
+                # back. If it never does, another trial is allowed after open_seconds.
+                self.__open_until = now + self.__open_seconds
+                return 0.0
+
+            self.__refill(now)
+            wait = max(self.__paused_until - now, (1 - self.__tokens) / self.__rate if self.__tokens < 1 else 0.0)
+            if now + wait > deadline:
+                raise UpstreamUnavailable("rate_limited")
+            # The bucket can go negative, which queues later callers behind the ones already waiting
+            self.__tokens -= 1
+            return wait
+
+    def try_reserve(self) -> bool:
+        # Takes a slot only if one is free right now, for optional calls like hedged requests
+        with self.__lock:
+            now = time.monotonic()
+            if self.__open_until is not None:
+                return False
+            self.__refill(now)
+            if self.__paused_until > now or self.__tokens < 1:
+                return False
+            self.__tokens -= 1
+            return True
+
+    def __refill(self, now: float):
+        # Must be called with the lock held
+        self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+    def pause(self, seconds: float):
+        # Makes every caller wait at least this long, e.g. for a Retry-After response header
+        with self.__lock:
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+
+    def record_success(self):
+        # The upstream answered, even if with a client error
+        with self.__lock:
+            self.__consecutive_failures = 0
+            self.__open_until = None
+
+    def record_failure(self):
+        # The upstream could not be reached or had a server error
+        with self.__lock:
+            self.__consecutive_failures += 1
+            if self.__open_until is not None or self.__consecutive_failures >= self.__failure_threshold:
+                self.__open_until = time.monotonic() + self.__open_seconds
+
+    @property
+    def is_open(self) -> bool:
+        with self.__lock:
+            return self.__open_until is not None
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    # Returns the number of seconds to wait for a Retry-After header, which is either seconds or an HTTP date
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
@@ -1,12 +1,12 @@
 import logging
 from datetime import datetime
 
-import cachetools.func
 from typing import Tuple, Optional, List, Dict, Any
 
 from flask import abort, current_app, jsonify, request
 from flask import Blueprint, g
 
+from backend.caching import single_flight_ttl_cache
 from backend.connections.autolab_api_connection import AutolabApiConnection
 from backend.connections.infosource_connection import InfoSourceConnection
 from backend.models.gat_models import CourseRole
@@ -18,7 +18,7 @@ logger = logging.getLogger("portal")
 cs = Blueprint("course_sections", __name__)
 
 
-@cachetools.func.ttl_cache(maxsize=100, ttl=60)
+@single_flight_ttl_cache(maxsize=100, ttl=60)
 def user_is_instructor_in_autolab_course(user_email: str, course_name: str) -> Tuple[bool, Optional[dict]]:
     # Returns a tuple with true if the user is an instructor in the course on Autolab, false otherwise
     # If true, also return the course information dict
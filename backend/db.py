@@ -14,7 +14,10 @@ postgres_port = os.getenv("POSTGRES_PORT")
 postgres_db = os.getenv("POSTGRES_DB")
 DATABASE_URL = f"postgresql://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db}"
 
-engine = create_engine(DATABASE_URL)
+# Each gunicorn thread uses at most one connection at a time, so pool_size + max_overflow should be at least the
+# number of threads per worker (GUNICORN_THREADS)
+engine = create_engine(DATABASE_URL, pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+                       max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)))
 get_db_session = scoped_session(
     sessionmaker(bind=engine, expire_on_commit=False))  # Use this in other files to get a session
 # For Flask requests, use g.db because it'll keep the session open for the whole request
@@ -26,3 +29,24 @@ def initialize():
     from backend.models.user import User  # Needed to create tables
     from backend.models.session import Session  # Needed to create tables
     Base.metadata.create_all(bind=engine)
+
+
+class LazyDbSession:
+    # Stands in for the database session in g.db. The real session is only created the first time it's used, so
+    # requests that never touch Postgres (like the Tango stats endpoints) don't check out a pooled connection at all.
+    # Everything except close() is passed through to the real session.
+
+    def __init__(self):
+        self.__session = None
+
+    def __getattr__(self, name):
+        # Only called for attributes this class doesn't define itself
+        if self.__session is None:
+            self.__session = get_db_session()
+        return getattr(self.__session, name)
+
+    def close(self):
+        # A no-op if the session was never used
+        if self.__session is not None:
+            self.__session.close()
+            self.__session = None
@@ -2,17 +2,19 @@ import logging
 import random
 from collections import defaultdict, OrderedDict as ordereddict
 
-import cachetools.func
 from typing import Tuple, Optional, List, Sequence, Set, Dict, DefaultDict, OrderedDict
 
 from flask import abort, current_app, jsonify, request
 from flask import Blueprint, g
 
+from backend.caching import single_flight_ttl_cache
+from backend.connections.async_autolab_api_connection import AsyncAutolabApiConnection
 from backend.connections.autolab_api_connection import AutolabApiConnection
 from backend.models.gat_models import Course, CourseUser, CourseConflictOfInterest, CourseGradingAssignment, \
     CourseGradingAssignmentPair, CourseRole
 from backend.models.user import User
 from backend.per_user_rate_limiter import rate_limit_per_user
+from backend.request_deadline import request_deadline
 
 logger = logging.getLogger("portal")
 
@@ -53,7 +55,11 @@ def user_has_role_in_autolab_course(user_email: str, course_name: str, roles: Li
     # Returns tuple with true if the user has any of the given roles in the course on Autolab, false otherwise
     # If true, also return the course information dict
     autolab: AutolabApiConnection = current_app.autolab
-    user_courses: dict = autolab.user_courses(user_email)
+    return user_courses_include_role(autolab.user_courses(user_email), course_name, roles)
+
+
+def user_courses_include_role(user_courses: dict, course_name: str, roles: List) -> Tuple[bool, Optional[dict]]:
+    # Like user_has_role_in_autolab_course, for a response from AutolabApiConnection.user_courses fetched by the caller
     for course in user_courses["courses"]:
         if course["name"] == course_name:
             if string_to_course_role(course["role"]) in roles:
@@ -62,7 +68,7 @@ def user_has_role_in_autolab_course(user_email: str, course_name: str, roles: Li
     return False, None
 
 
-@cachetools.func.ttl_cache(maxsize=100, ttl=60)
+@single_flight_ttl_cache(maxsize=100, ttl=60)
 def user_is_grader_in_autolab_course(user_email: str, course_name: str) -> Tuple[bool, Optional[dict]]:
     # Returns true if the user is an instructor or CA in the course on Autolab, false otherwise
     # If true, also return the course information dict
@@ -641,10 +647,17 @@ def course_autolab_assessments_view(course_name: str):
     # Get all Autolab assessments in a course. Requires being a grader in the course locally and on Autolab.
     course: Course = get_course_by_name_or_404(course_name)
     ensure_user_is_grader_in_course(g.user, course)
-    ensure_current_user_is_grader_in_autolab_course(course_name)
 
-    autolab: AutolabApiConnection = current_app.autolab
-    assessments = autolab.course_assessments(course_name)["assessments"]
+    # Check the Autolab role and fetch the assessments concurrently
+    autolab_async: AsyncAutolabApiConnection = current_app.autolab_async
+    if g.user.is_admin:
+        course_assessments = autolab_async.run(autolab_async.course_assessments(course_name))
+    else:
+        user_courses, course_assessments = autolab_async.gather(autolab_async.user_courses(g.user.email),
+                                                                autolab_async.course_assessments(course_name))
+        if not user_courses_include_role(user_courses, course_name, [CourseRole.INSTRUCTOR, CourseRole.TA])[0]:
+            abort(403, "You are not an instructor or course assistant in this course on Autolab.")
+    assessments = course_assessments["assessments"]
 
     data = {
         "course": course.to_dict(),
@@ -659,6 +672,7 @@ def course_autolab_assessments_view(course_name: str):
 
 @gat.route("/course/<course_name>/create-grading-assignment/<assessment_name>/", methods=["POST"])
 @rate_limit_per_user(1, 5)  # 1 request per 5 seconds (this is a slow operation)
+@request_deadline(10)
 def course_create_grading_assignment_view(course_name: str, assessment_name: str):
     # Create a new grading assignment for an Autolab assessment in a course. Requires being a grader in the course.
     # Maps graders to students who submitted the assessment accounting for conflicts of interest and grading hours.
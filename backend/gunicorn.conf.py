@@ -0,0 +1,38 @@
+# Gunicorn configuration, used with `gunicorn -c gunicorn.conf.py server:gunicorn_app`
+# Most request time is spent waiting on Autolab, Tango, InfoSource, and Postgres, so each worker process runs several
+# threads. Shared state in the app (caches, rate limiters, connections) is safe to use from multiple threads.
+import os
+import shutil
+
+from dotenv import load_dotenv
+
+load_dotenv()  # The master reads the settings below before the app, which also loads .env, is imported
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5057")
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 8))  # Keep DB_POOL_SIZE + DB_MAX_OVERFLOW at least this high
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+
+# Lets Prometheus metrics add up across workers. Workers inherit this from the master. See metrics.py.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "mount/prometheus")
+
+
+def on_starting(server):
+    # Runs once in the master process before any workers are forked
+
+    # The master owns the log files, and workers send their log records to it over a local socket, so rotation only
+    # ever happens in one process
+    from backend.log_server import start_log_server
+    port = start_log_server("127.0.0.1", 0, "mount/logs")
+    os.environ["PORTAL_LOG_SERVER"] = f"127.0.0.1:{port}"  # Inherited by the workers
+
+    # Metrics from a previous run of the server would otherwise be added to this one
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    # Stops reporting gauges for workers that have exited. Their counters and histograms are still included.
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
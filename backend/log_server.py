@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import socketserver
+import struct
+import threading
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, SocketHandler
+from typing import Dict
+
+logger = logging.getLogger("portal")
+
+PORTAL_LOG_FORMAT = "%(asctime)s %(levelname)s %(request_id)s %(username)s%(indent)s %(message)s (%(module)s)"
+ACCESS_LOGGER_NAME = "portal.access"  # One JSON object per line, one line per request
+
+
+class JsonFormatter(logging.Formatter):
+    # Formats records logged like logger.info("...", extra={"fields": {...}}) as a single line of JSON
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            **getattr(record, "fields", {"message": record.getMessage()}),
+        }, default=str)
+
+
+class RoutingHandler(logging.Handler):
+    # Passes each record to the handler for its logger's name, so one writer can own several log files
+
+    def __init__(self, handlers: Dict[str, logging.Handler], default: logging.Handler):
+        super().__init__()
+        self.handlers = handlers
+        self.default = default
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        return self.handlers.get(record.name, self.default).handle(record)
+
+
+def create_log_file_handler(log_directory: str) -> RoutingHandler:
+    # Writes the portal log to portal.log and the access log to access.log in the given directory
+    os.makedirs(log_directory, exist_ok=True)
+    portal_handler = RotatingFileHandler(os.path.join(log_directory, "portal.log"),
+                                         maxBytes=10_000_000, backupCount=5_000)
+    portal_handler.setFormatter(logging.Formatter(PORTAL_LOG_FORMAT))
+    access_handler = RotatingFileHandler(os.path.join(log_directory, "access.log"),
+                                         maxBytes=10_000_000, backupCount=1_000)
+    access_handler.setFormatter(JsonFormatter())
+    return RoutingHandler({ACCESS_LOGGER_NAME: access_handler}, portal_handler)
+
+
+class JsonSocketHandler(SocketHandler):
+    # Sends records to the log server as JSON instead of pickles, so the server never unpickles data from its socket,
+    # which any local process can connect to
+    # Like SocketHandler: a 4-byte big-endian length, then the record's attributes with the message already formatted
+
+    def makePickle(self, record: logging.LogRecord) -> bytes:
+        if record.exc_info:
+            self.format(record)  # Caches the traceback in record.exc_text, which is sent instead
+        data = dict(record.__dict__)
+        data["msg"] = record.getMessage()
+        data["args"] = None
+        data["exc_info"] = None
+        data.pop("message", None)
+        encoded = json.dumps(data, default=str).encode("utf-8")
+        return struct.pack(">L", len(encoded)) + encoded
+
+
+class LogRecordStreamHandler(socketserver.StreamRequestHandler):
+    # Reads records sent by JsonSocketHandler
+    # Based on https://docs.python.org/3/howto/logging-cookbook.html#sending-and-receiving-logging-events-across-a-network
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                break
+            length = struct.unpack(">L", header)[0]
+            data = self.rfile.read(length)
+            if len(data) < length:
+                break
+            try:
+                attributes = json.loads(data)
+            except ValueError:
+                break  # Not from a JsonSocketHandler, so the rest of the stream can't be trusted to line up either
+            if isinstance(attributes, dict):
+                self.server.target.handle(logging.makeLogRecord(attributes))
+
+
+class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, target: logging.Handler):
+        super().__init__(address, LogRecordStreamHandler)
+        self.target = target  # Handlers lock around emit(), so connection threads can share it
+
+
+def start_log_server(host: str, port: int, log_directory: str) -> int:
+    # Starts the single writer for the log files in a background thread and returns the port it's listening on.
+    # This is meant to run in the gunicorn master process so that exactly one process writes and rotates each file.
+    # Pass port 0 to let the OS choose a free port.
+    receiver = LogRecordSocketReceiver((host, port), create_log_file_handler(log_directory))
+    threading.Thread(target=receiver.serve_forever, name="log-server", daemon=True).start()
+    return receiver.server_address[1]
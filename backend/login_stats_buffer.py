@@ -0,0 +1,65 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Tuple
+
+from sqlalchemy import text
+
+from backend.db import engine
+
+logger = logging.getLogger("portal")
+
+
+class LoginStatsBuffer:
+    # Login counts and last login times are informational, so they're kept out of the login transaction.
+    # Logins are recorded here in memory, and a background thread writes them all in one transaction every
+    # `flush_interval` seconds. Buffered logins are also written when the process exits normally.
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.__pending: Dict[int, Tuple[int, datetime]] = {}  # user id -> (number of logins, last login time)
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<LoginStatsBuffer {len(self.__pending)} users pending, flushed every {self.flush_interval} seconds>"
+
+    def record_login(self, user_id: int):
+        with self.__lock:
+            count, _ = self.__pending.get(user_id, (0, None))
+            self.__pending[user_id] = (count + 1, datetime.now(timezone.utc))
+
+    def pending_logins(self, user_id: int) -> int:
+        with self.__lock:
+            return self.__pending.get(user_id, (0, None))[0]
+
+    def flush(self):
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+        if len(pending) == 0:
+            return
+        rows = [{"user_id": user_id, "count": count, "last_login": last_login}
+                for user_id, (count, last_login) in pending.items()]
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("UPDATE users SET login_count = login_count + :count, "
+                                  "last_login = GREATEST(COALESCE(last_login, :last_login), :last_login) "
+                                  "WHERE id = :user_id"), rows)
+            logger.debug(f"Flushed login stats for {len(rows)} users")
+        except Exception as e:
+            logger.error(f"Failed to flush login stats. Keeping them for the next attempt. {e}")
+            with self.__lock:
+                for user_id, (count, last_login) in pending.items():
+                    newer_count, newer_last_login = self.__pending.get(user_id, (0, last_login))
+                    self.__pending[user_id] = (count + newer_count, max(last_login, newer_last_login))
+
+    def __flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        logger.debug(f"Starting {self}")
+        threading.Thread(target=self.__flush_forever, name="login-stats-buffer", daemon=True).start()
+        atexit.register(self.flush)
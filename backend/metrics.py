@@ -0,0 +1,75 @@
+import os
+import time
+from typing import Tuple
+
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Prometheus metrics for the portal, served by the user API at /api/user_api/metrics/
+# Under gunicorn, PROMETHEUS_MULTIPROC_DIR is set by gunicorn.conf.py before the workers start. Each worker then writes
+# its samples to files in that directory, and a scrape of any worker reports the sum across all of them.
+
+# Upstream calls range from a few milliseconds (Postgres) to several seconds (creating courses on Autolab)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUEST_DURATION = Histogram("portal_request_duration_seconds", "Time to handle a request",
+                             ["blueprint", "route", "method", "status"], buckets=LATENCY_BUCKETS)
+RATE_LIMITED_REQUESTS = Counter("portal_rate_limited_requests_total", "Requests rejected by rate_limit_per_user",
+                                ["blueprint", "route"])
+UPSTREAM_DURATION = Histogram("portal_upstream_duration_seconds", "Time spent in calls to Autolab, Tango, and "
+                              "InfoSource", ["service", "operation"], buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter("portal_upstream_errors_total", "Failed calls to Autolab, Tango, and InfoSource",
+                          ["service", "operation"])
+UPSTREAM_THROTTLED = Counter("portal_upstream_throttled_total", "Calls to Autolab that were not made because the "
+                             "client-side throttle would not start them in time or the circuit breaker was open",
+                             ["service", "reason"])
+UPSTREAM_RETRY_AFTER = Counter("portal_upstream_retry_after_total", "429 responses that were retried after waiting "
+                               "for Retry-After", ["service"])
+UPSTREAM_HEDGED = Counter("portal_upstream_hedged_requests_total", "Second copies of slow GET requests sent to cut "
+                          "tail latency", ["service"])
+SQL_DURATION = Histogram("portal_sql_duration_seconds", "Time to execute SQL statements", ["statement"],
+                         buckets=LATENCY_BUCKETS)
+SQL_ERRORS = Counter("portal_sql_errors_total", "SQL statements that raised an error", ["statement"])
+CACHE_REQUESTS = Counter("portal_cache_requests_total", "Lookups in single-flight caches by result: hit, stale (served "
+                         "while refreshing in the background), miss (the caller fetched the value), or coalesced (the "
+                         "caller waited for another caller's fetch)", ["cache", "result"])
+SESSIONS_PRUNED = Counter("portal_sessions_pruned_total", "Rows deleted from the sessions table by SessionPruner")
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    # Returns the response body and content type for a scrape
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def statement_type(statement: str) -> str:
+    # Like "SELECT" or "UPDATE". The full statement would make far too many label values.
+    words = statement.split(None, 1)
+    return words[0].upper() if len(words) > 0 else "UNKNOWN"
+
+
+def instrument_engine(engine: Engine):
+    # Records the duration of every SQL statement executed through the engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["metrics_query_start"].pop()
+        SQL_DURATION.labels(statement_type(statement)).observe(time.perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        starts = exception_context.connection.info.get("metrics_query_start") \
+            if exception_context.connection is not None else None
+        if starts:
+            starts.pop()
+        SQL_ERRORS.labels(statement_type(exception_context.statement or "")).inc()
@@ -1,6 +1,6 @@
 import enum
 
-from sqlalchemy import DateTime, func, ForeignKey, UniqueConstraint
+from sqlalchemy import DateTime, func, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from backend.db import Base
@@ -32,6 +32,10 @@ class Course(Base):
 
 class CourseUser(Base):
     __tablename__ = "course_users"
+    __table_args__ = (
+        UniqueConstraint("course_id", "email"),  # Also serves lookups by course_id alone
+        Index("ix_course_users_email", "email"),  # For finding every course a grader is in
+    )
 
     # Note that the "user" may not exist in our database, so we can only store their email address
 
@@ -43,8 +47,6 @@ class CourseUser(Base):
     role: Mapped[CourseRole] = mapped_column(nullable=False)
     grading_hours: Mapped[int] = mapped_column(nullable=False, default=0)
 
-    UniqueConstraint(course_id, email)
-
     def is_grader(self) -> bool:
         return self.role == CourseRole.INSTRUCTOR or self.role == CourseRole.TA
 
@@ -63,6 +65,10 @@ class CourseUser(Base):
 
 class CourseConflictOfInterest(Base):
     __tablename__ = "course_conflicts_of_interest"
+    __table_args__ = (
+        UniqueConstraint("course_id", "grader_email", "student_email"),  # Also serves (course_id, grader_email)
+        Index("ix_course_conflicts_of_interest_course_id_student_email", "course_id", "student_email"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     course_id: Mapped[int] = mapped_column(ForeignKey("courses.id"), nullable=False)
@@ -70,8 +76,6 @@ class CourseConflictOfInterest(Base):
     grader_email: Mapped[str] = mapped_column(nullable=False)  # They may not exist as a user in our database
     student_email: Mapped[str] = mapped_column(nullable=False)
 
-    UniqueConstraint(course_id, grader_email, student_email)
-
     def to_dict(self):
         return {
             "grader_email": self.grader_email,
@@ -107,6 +111,9 @@ class CourseGradingAssignment(Base):
 
 class CourseGradingAssignmentPair(Base):
     __tablename__ = "course_grading_assignment_pairs"
+    __table_args__ = (
+        UniqueConstraint("course_grading_assignment_id", "grader_email", "student_email"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     course_grading_assignment_id: Mapped[int] = mapped_column(
@@ -119,8 +126,6 @@ class CourseGradingAssignmentPair(Base):
     completed: Mapped[bool] = mapped_column(nullable=False, default=False)
     submission_version: Mapped[int] = mapped_column(nullable=False, default=0)
 
-    UniqueConstraint(course_grading_assignment_id, grader_email, student_email)
-
     def to_dict(self):
         # This is less verbose than most because it will be called many times to build a list
         return {
@@ -1,25 +1,52 @@
 import datetime
 import logging
+import os
+import threading
 
+import cachetools
 import pytz
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Dict, Any
 
 from flask import g
 from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func
+from sqlalchemy.orm import make_transient_to_detached
 from backend.db import Base
 from backend.models.user import User
+from backend.session_tokens import signed_tokens_enabled, is_signed_token, sign_session_token, \
+    verify_session_token, revoked_sessions
 from backend.utils import generate_random_string, sha256_hash
 
 logger = logging.getLogger("portal")
 
+# Authenticated requests would otherwise cost a sessions lookup plus a users lookup before any handler runs.
+# hashed token -> (session id, user id, expires at) and user id -> snapshot of the user's columns.
+# The TTL bounds how long a logout or admin change made in a *different* gunicorn worker can go unnoticed here.
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 30))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10_000))
+_token_cache: cachetools.TTLCache = cachetools.TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+_user_cache: cachetools.TTLCache = cachetools.TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+_cache_lock = threading.Lock()  # cachetools caches aren't thread-safe
+
+
+def _snapshot_user(user: User) -> Dict[str, Any]:
+    return {column.key: getattr(user, column.key) for column in User.__table__.columns}
+
+
+def _user_from_snapshot(snapshot: Dict[str, Any]) -> User:
+    # Rebuild the user and attach it to this request's session without querying the database
+    # It behaves like a loaded user, so changes to it can still be committed with g.db.commit()
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return g.db.merge(user, load=False)
+
 
 class Session(Base):
     __tablename__ = "sessions"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
-    hashed_token = Column(String, nullable=False)
-    expires_at = Column(DateTime(timezone=True), nullable=False)
+    hashed_token = Column(String, nullable=False, index=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     logged_out_at = Column(DateTime(timezone=True), default=None)
 
@@ -36,6 +63,11 @@ class Session(Base):
             expires_at=datetime.datetime.now() + datetime.timedelta(days=15),
         )
         g.db.add(s)
+        if signed_tokens_enabled():
+            # The signed token includes the session ID, so the row needs one before the token can be made
+            g.db.flush()
+            token = sign_session_token(s.id, user.id, s.expires_at.timestamp())
+            s.hashed_token = sha256_hash(token)
         g.db.commit()
         logger.info(f"Success. Session id {s.id} expires at {s.expires_at}")
         return s, token
@@ -45,6 +77,16 @@ class Session(Base):
         self.logged_out_at = func.now()
         logger.info(f"Logging out session {self.id} for user {self.user.username}")
         g.db.commit()
+        with _cache_lock:
+            _token_cache.pop(self.hashed_token, None)
+        revoked_sessions.revoke(self.id)
+
+    @staticmethod
+    def forget_user(user: User):
+        # Drop the cached copy of a user. Call this after changing anything that's shown to or checked for the user,
+        # like is_admin or preferred_name, so the next request reads the new values from the database.
+        with _cache_lock:
+            _user_cache.pop(user.id, None)
 
     @staticmethod
     def get_session(unhashed_token) -> Optional["Session"]:
@@ -52,15 +94,57 @@ class Session(Base):
         session = g.db.query(Session).filter(Session.hashed_token == hashed_token).first()
         return session
 
+    @staticmethod
+    def get_user_from_signed_token(token: str) -> Optional[User]:
+        # Verifies the token's signature, expiration, and revocation without looking up the session in the database
+        claims = verify_session_token(token)
+        if claims is None:
+            return None
+        session_id, user_id, _ = claims
+        if revoked_sessions.is_revoked(session_id):
+            logger.warning(f"Old session rejected <Session {session_id}> (logged out)")
+            return None
+        with _cache_lock:
+            snapshot = _user_cache.get(user_id)
+        if snapshot is not None:
+            return _user_from_snapshot(snapshot)
+        user: Optional[User] = g.db.get(User, user_id)
+        if user is not None:
+            with _cache_lock:
+                _user_cache[user.id] = _snapshot_user(user)
+        return user
+
     @staticmethod
     def get_user(unhashed_token) -> Optional[User]:
         # Given an unhashed token, return the user associated with the session if one exists
-        session = Session.get_session(unhashed_token)
-        if session is None or session.expires_at < datetime.datetime.now(pytz.utc) or session.logged_out_at is not None:
+        # Recently used sessions are answered from memory, so this usually doesn't touch the database
+        if signed_tokens_enabled() and is_signed_token(unhashed_token):
+            return Session.get_user_from_signed_token(unhashed_token)
+        hashed_token = sha256_hash(unhashed_token)
+        now = datetime.datetime.now(pytz.utc)
+        with _cache_lock:
+            cached_session = _token_cache.get(hashed_token)
+            snapshot = _user_cache.get(cached_session[1]) if cached_session is not None else None
+        if cached_session is not None:
+            session_id, user_id, expires_at = cached_session
+            if expires_at < now:
+                with _cache_lock:
+                    _token_cache.pop(hashed_token, None)
+                logger.warning(f"Old session rejected <Session {session_id}> (expired while cached)")
+                return None
+            if snapshot is not None:
+                return _user_from_snapshot(snapshot)
+
+        session = g.db.query(Session).filter(Session.hashed_token == hashed_token).first()
+        if session is None or session.expires_at < now or session.logged_out_at is not None:
             if session is not None:
                 logger.warning(f"Old session rejected {session}")
             return None
-        return session.user
+        user: User = session.user
+        with _cache_lock:
+            _token_cache[hashed_token] = (session.id, user.id, session.expires_at)
+            _user_cache[user.id] = _snapshot_user(user)
+        return user
 
     def __repr__(self):
         return f"<Session {self.id} ({self.user.username}) expires at {self.expires_at} logged out at " \
@@ -1,11 +1,14 @@
 import logging
+import os
 
 from flask import g
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, func
 from sqlalchemy.orm import relationship
 from backend.db import Base
+from backend.login_stats_buffer import LoginStatsBuffer
 
 logger = logging.getLogger("portal")
+login_stats = LoginStatsBuffer(float(os.getenv("LOGIN_STATS_FLUSH_INTERVAL", 10)))
 
 
 class User(Base):
@@ -35,15 +38,15 @@ class User(Base):
             person_number=person_number,
         )
         g.db.add(u)
-        g.db.commit()
+        g.db.flush()  # Assigns the ID. It's committed together with the rest of the login.
         logger.info(f"Created new user {u.to_dict()}")
         return u
 
     def login(self):
-        self.login_count += 1
-        self.last_login = func.now()
-        logger.info(f"User {self.username} logged in. This is their login number {self.login_count}")
-        g.db.commit()
+        # login_count and last_login are written in the background by login_stats
+        login_stats.record_login(self.id)
+        logger.info(f"User {self.username} logged in. This is their login number "
+                    f"{self.login_count + login_stats.pending_logins(self.id)}")
 
     def display_first_name(self):
         return self.preferred_name or self.first_name
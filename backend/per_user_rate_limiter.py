@@ -1,9 +1,12 @@
+import threading
 from datetime import datetime
 from collections import deque
 from functools import wraps
 from typing import Dict
 
-from flask import g, jsonify
+from flask import g, jsonify, request
+
+from backend.metrics import RATE_LIMITED_REQUESTS
 
 
 class PerUserRateLimiter:
@@ -12,6 +15,7 @@ class PerUserRateLimiter:
         self.times_per_period = times_per_period
         self.seconds = seconds
         self.__users: Dict[str, deque] = {}
+        self.__lock = threading.Lock()  # Requests for the same user can be handled concurrently by different threads
 
     def __repr__(self):
         return f"<RateLimiter {self.times_per_period} times per {self.seconds} seconds>"
@@ -26,27 +30,29 @@ class PerUserRateLimiter:
     def try_use(self, username: str):
         # Returns True if the user is allowed access at this time, False otherwise
         # Adds the current time to the user's queue if they are allowed access
-        if username not in self.__users:
-            self.__users[username] = deque()
-        user_queue = self.__users[username]
-        now = datetime.now()
-        self.update_to_current_time(now, user_queue)
-        if len(user_queue) < self.times_per_period:
-            user_queue.append(now)
-            return True
-        return False
+        with self.__lock:
+            if username not in self.__users:
+                self.__users[username] = deque()
+            user_queue = self.__users[username]
+            now = datetime.now()
+            self.update_to_current_time(now, user_queue)
+            if len(user_queue) < self.times_per_period:
+                user_queue.append(now)
+                return True
+            return False
 
     def get_remaining_time(self, username: str) -> float:
         # Return the number of seconds remaining until the given user can perform an action again
         # Returns 0.0 if the user can perform an action now
-        if username not in self.__users:
-            return 0.0
-        user_queue = self.__users[username]
-        now = datetime.now()
-        self.update_to_current_time(now, user_queue)
-        if len(user_queue) < self.times_per_period:
-            return 0.0
-        return max(self.seconds - (now - user_queue[0]).total_seconds(), 0.0)
+        with self.__lock:
+            if username not in self.__users:
+                return 0.0
+            user_queue = self.__users[username]
+            now = datetime.now()
+            self.update_to_current_time(now, user_queue)
+            if len(user_queue) < self.times_per_period:
+                return 0.0
+            return max(self.seconds - (now - user_queue[0]).total_seconds(), 0.0)
 
     @staticmethod
     def human_readable_seconds(seconds: float) -> str:
@@ -92,12 +98,13 @@ def rate_limit_per_user(times_per_period: int, seconds: float):
             if not limiter.try_use(g.user.username):
                 remaining_time: str = PerUserRateLimiter.human_readable_seconds(
                     limiter.get_remaining_time(g.user.username))
-                resp = jsonify({
+                RATE_LIMITED_REQUESTS.labels(request.blueprint, request.url_rule.rule).inc()
+                g.error = f"You've exceeded your rate limit. You'll need to wait {remaining_time} before trying" \
+                          " that again."
+                return jsonify({
                     "success": False,
-                    "error": f"You've exceeded your rate limit. You'll need to wait {remaining_time} before trying"
-                             " that again."
-                })
-                return resp, 429
+                    "error": g.error
+                }), 429
             return func(*args, **kwargs)
 
         return wrapper
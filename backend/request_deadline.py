@@ -0,0 +1,53 @@
+import os
+import time
+from functools import wraps
+from typing import Optional
+
+from flask import abort, g, has_request_context
+
+# Time budget for handling a request, shared by every upstream call made while handling it
+# Views that need a different budget use the request_deadline decorator. Outside of a request, for example in
+# background refreshes, upstream calls only use their own timeouts.
+DEFAULT_REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE_SECONDS", 30))
+
+
+def start_request_deadline(seconds: float = DEFAULT_REQUEST_DEADLINE):
+    # Sets the deadline of the current request to this many seconds from now
+    g.deadline = time.monotonic() + seconds
+
+
+def request_deadline(seconds: float):
+    # Decorator to give a view its own budget instead of DEFAULT_REQUEST_DEADLINE
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start_request_deadline(seconds)
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current_deadline() -> Optional[float]:
+    # Returns the time.monotonic() deadline of the current request, or None outside of a request or without one
+    if not has_request_context():
+        return None
+    return g.get("deadline")
+
+
+def upstream_timeout(default: float) -> float:
+    # Returns the timeout for an upstream call: its own default, or less if the request's deadline is closer
+    # Aborts the request with 504 if its deadline has already passed, since a call now could only fail
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        abort_past_deadline()
+    return min(default, remaining)
+
+
+def abort_past_deadline():
+    abort(504, "The request took too long. Try again in a moment.")
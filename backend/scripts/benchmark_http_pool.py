@@ -0,0 +1,52 @@
+# Compares Autolab API calls made with a new connection each time (module-level requests.request, as the portal
+# used to) against calls through PooledHttpSession, using the fake Autolab server from fake_autolab.py.
+#   python -m backend.scripts.benchmark_http_pool [--calls 300] [--latency 0.0]
+# The fake server speaks plain HTTP, so this only measures the TCP handshake and connection setup. Against the real
+# Autolab over HTTPS, every new connection also pays for a TLS handshake, so the difference is larger.
+
+import argparse
+import statistics
+import time
+from typing import Callable, List
+
+import requests
+
+from backend.connections.http_session import PooledHttpSession
+from backend.scripts.fake_autolab import start_fake_autolab
+
+
+def time_calls(call: Callable[[], requests.Response], calls: int) -> List[float]:
+    latencies: List[float] = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call().raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name: str, latencies: List[float]):
+    latencies = sorted(latencies)
+    print(f"{name:<28} mean {statistics.mean(latencies) * 1000:7.2f} ms   "
+          f"p50 {latencies[len(latencies) // 2] * 1000:7.2f} ms   "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pooled versus unpooled HTTP calls to a fake Autolab.")
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.0, help="Server-side delay per response in seconds")
+    args = parser.parse_args()
+
+    fake = start_fake_autolab(args.latency)
+    url = f"{fake.root}/api/ubcseit/course_assessments"
+    params = {"course_name": "cse116-f26", "access_token": "benchmark"}
+    pooled = PooledHttpSession(pool_size=10, retries=0)
+    pooled.get(url, params=params)  # Open the connection so both sides start warm apart from connection setup
+
+    print(f"{args.calls} sequential GET {url}")
+    report("New connection per call", time_calls(lambda: requests.request("GET", url, params=params), args.calls))
+    report("PooledHttpSession", time_calls(lambda: pooled.get(url, params=params), args.calls))
+
+
+if __name__ == '__main__':
+    main()
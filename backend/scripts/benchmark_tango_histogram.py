@@ -0,0 +1,91 @@
+# Compares the Tango submission histogram as it used to be computed (every job checked against every window on each
+# call) against the sorted timestamps and binary searches in TangoApiConnection, using synthetic jobs spread over
+# the past 30 days.
+#   python -m backend.scripts.benchmark_tango_histogram [--jobs 100000] [--calls 20]
+# No Tango server is needed, the synthetic jobs are ingested into a TangoHistory in a temporary directory.
+
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from backend.connections.tango_api_connection import DEFAULT_SAMPLE_SECONDS, TangoApiConnection
+from backend.tango_history import TangoHistory
+
+
+def synthetic_jobs(count: int) -> List[dict]:
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    jobs = []
+    for i in range(count):
+        start = now - datetime.timedelta(seconds=random.uniform(0, 2592000))
+        jobs.append({"id": i, "trace": [f"{start.strftime('%a %b %d %H:%M:%S %Y')}|Added job cse116:{i} to queue"]})
+    return jobs
+
+
+def per_job_histogram(tango: TangoApiConnection) -> Dict[int, int]:
+    # The histogram as computed before the timestamps were kept sorted
+    submission_dates = tango.get_recent_submission_times()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    histogram: Dict[int, int] = {k: 0 for k in DEFAULT_SAMPLE_SECONDS}
+    for date in submission_dates:
+        seconds_ago: float = (now - date).total_seconds()
+        for seconds in DEFAULT_SAMPLE_SECONDS:
+            if seconds_ago < seconds:
+                histogram[seconds] += 1
+    return histogram
+
+
+def mean_time(call: Callable[[], object], calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        call()
+    return (time.perf_counter() - start) / calls
+
+
+def report(name: str, seconds: float):
+    print(f"{name:<36} {seconds * 1000:9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Tango submission histogram.")
+    parser.add_argument("--jobs", type=int, default=100000)
+    parser.add_argument("--calls", type=int, default=20)
+    args = parser.parse_args()
+
+    tango = TangoApiConnection("http://tango.invalid", "benchmark")
+    jobs = synthetic_jobs(args.jobs)
+
+    with tempfile.TemporaryDirectory() as directory:
+        history = TangoHistory(os.path.join(directory, "tango_history.bin"))
+        start = time.perf_counter()
+        # What TangoPoller does after each poll, here with every job new as on the first poll
+        history.ingest(jobs)
+        tango.snapshot = history.snapshot()
+        first = time.perf_counter() - start
+    histogram = tango.get_recent_submissions_histogram()
+    assert histogram == per_job_histogram(tango), "The histograms differ"
+    # The last 1440 whole minutes, plus the current one so far
+    counts = tango.get_submission_time_series(60)["counts"]
+    bounds = tango.get_recent_submissions_histogram([86340, 86400])
+    assert len(counts) == 1440 and bounds[86340] <= sum(counts) <= bounds[86400], \
+        "The series doesn't add up to the histogram"
+
+    windows = list(range(1, 2592001, 2592))
+    print(f"{args.jobs} jobs, mean of {args.calls} calls")
+    # The old code also parsed every job on every call. A poll now only parses the jobs it hasn't seen, so the cost of
+    # parsing all of them is only paid on the first poll, which the ingest line shows.
+    report(f"Per job, {len(DEFAULT_SAMPLE_SECONDS)} windows, no parsing",
+           mean_time(lambda: per_job_histogram(tango), max(1, args.calls // 10)))
+    report("Ingest and snapshot after a poll", first)
+    report(f"Sorted, {len(DEFAULT_SAMPLE_SECONDS)} windows",
+           mean_time(tango.get_recent_submissions_histogram, args.calls))
+    report(f"Sorted, {len(windows)} windows",
+           mean_time(lambda: tango.get_recent_submissions_histogram(windows), args.calls))
+    report("Ring buffer, per minute for a day", mean_time(lambda: tango.get_submission_time_series(60), args.calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Checks AsyncAutolabApiConnection against the fake Autolab server from fake_autolab.py and compares fetching several
+# courses one after another with the synchronous client against fetching them concurrently with gather().
+#   python -m backend.scripts.check_async_autolab [--courses 10] [--latency 0.1]
+# Runs in a temporary directory, so the token files written under mount/ don't touch a real deployment.
+
+import argparse
+import os
+import tempfile
+import time
+
+from backend.connections.async_autolab_api_connection import AsyncAutolabApiConnection
+from backend.connections.autolab_api_connection import AutolabApiConnection, store_refresh_token
+from backend.scripts.fake_autolab import start_fake_autolab
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the async Autolab client against a fake Autolab.")
+    parser.add_argument("--courses", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.1, help="Server-side delay per response in seconds")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir("mount")
+    store_refresh_token("fake-refresh-token")
+    fake = start_fake_autolab(args.latency)
+    autolab = AutolabApiConnection(fake.root, "client-id", "client-secret", "callback")
+    autolab_async = AsyncAutolabApiConnection(autolab)
+    course_names = [f"cse{100 + i}-f26" for i in range(args.courses)]
+
+    start = time.perf_counter()
+    expected = [autolab.course_users(course_name) for course_name in course_names]
+    sequential = time.perf_counter() - start
+    for cached_method in (AutolabApiConnection.course_users, AutolabApiConnection.course_assessments):
+        cached_method.cache_clear()
+
+    autolab_async.run(autolab_async.course_assessments("warm-up"))  # Start the event loop and the client
+    start = time.perf_counter()
+    results = autolab_async.gather(*[autolab_async.course_users(course_name) for course_name in course_names])
+    concurrent = time.perf_counter() - start
+    assert results == expected, "Async results differ from the synchronous client"
+
+    # Entries stored by the async client are hits for the synchronous one
+    requests_before = fake.request_count
+    autolab.course_users(course_names[0])
+    assert fake.request_count == requests_before, "Synchronous client missed an entry stored by the async client"
+
+    # Failures are raised from gather, or returned with return_exceptions=True
+    missing = autolab_async.gather(autolab_async.make_api_request("GET", "/api/ubcseit/missing", {}),
+                                   return_exceptions=True)[0]
+    assert isinstance(missing, Exception), "A failed request did not raise"
+
+    print(f"course_users for {args.courses} courses with {args.latency * 1000:.0f} ms latency")
+    print(f"Sequential, AutolabApiConnection    {sequential * 1000:8.1f} ms")
+    print(f"gather, AsyncAutolabApiConnection   {concurrent * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
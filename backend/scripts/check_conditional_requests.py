@@ -0,0 +1,65 @@
+# Checks conditional GET requests to the fake Autolab server from fake_autolab.py. Makes sure that repeated
+# course_users calls are answered with 304 Not Modified and the remembered body, and that changed rosters are
+# downloaded again, for both the synchronous and the async client. Then times both kinds of refetch.
+#   python -m backend.scripts.check_conditional_requests [--students 2000] [--calls 50]
+# Runs in a temporary directory, so the token files written under mount/ don't touch a real deployment.
+
+import argparse
+import os
+import tempfile
+import time
+
+from backend.connections.async_autolab_api_connection import AsyncAutolabApiConnection
+from backend.connections.autolab_api_connection import AutolabApiConnection, store_refresh_token
+from backend.scripts.fake_autolab import start_fake_autolab, synthetic_responses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check conditional Autolab requests against a fake Autolab.")
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=50)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir("mount")
+    store_refresh_token("fake-refresh-token")
+    fake = start_fake_autolab(students=args.students)
+    autolab = AutolabApiConnection(fake.root, "client-id", "client-secret", "callback")
+    autolab_async = AsyncAutolabApiConnection(autolab)
+
+    def fetch_roster(course_name: str) -> dict:
+        AutolabApiConnection.course_users.cache_clear()  # Make every call go to the fake server
+        return autolab.course_users(course_name)
+
+    first = fetch_roster("cse116-f26")
+    second = fetch_roster("cse116-f26")
+    assert fake.not_modified_count == 1, "The second request was not answered with 304"
+    assert second == first, "The remembered body differs from the original response"
+
+    # A changed roster has a different ETag, so it is downloaded again
+    fake.responses["/api/ubcseit/course_users"] = synthetic_responses(args.students + 1)["/api/ubcseit/course_users"]
+    changed = fetch_roster("cse116-f26")
+    assert fake.not_modified_count == 1 and len(changed["users"]) == len(first["users"]) + 1, \
+        "A changed roster was not downloaded again"
+
+    # The async client shares the remembered validators
+    AutolabApiConnection.course_users.cache_clear()
+    assert autolab_async.run(autolab_async.course_users("cse116-f26")) == changed
+    assert fake.not_modified_count == 2, "The async client did not send a conditional request"
+
+    start = time.perf_counter()
+    for _ in range(args.calls):
+        fetch_roster("cse116-f26")
+    not_modified = (time.perf_counter() - start) / args.calls
+    start = time.perf_counter()
+    for i in range(args.calls):
+        fetch_roster(f"cse{i}-f26")  # Never requested before, so always a full download
+    full = (time.perf_counter() - start) / args.calls
+
+    print(f"course_users with {args.students} students, mean of {args.calls} calls")
+    print(f"Full response      {full * 1000:7.2f} ms")
+    print(f"304 Not Modified   {not_modified * 1000:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# Shows the effect of the indexes added in revision 5b7c2e91d4a3 on the lookups that run on every request.
+# Everything happens in one transaction that is rolled back at the end, so nothing is left behind in the database:
+#   1. Drop the indexes from that revision if they exist
+#   2. Seed a large synthetic dataset
+#   3. Print EXPLAIN ANALYZE for each hot lookup
+#   4. Apply the revision's upgrade() and print EXPLAIN ANALYZE again
+# Run it against a development database from the repository root (so `backend` is importable):
+#   python -m backend.scripts.explain_hot_lookups [--sessions 500000] [--courses 500] [--users-per-course 400]
+
+import argparse
+import importlib.util
+import os
+from typing import List, Tuple
+
+from alembic.operations import Operations
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from backend.db import engine
+
+MIGRATION_PATH = os.path.join(os.path.dirname(__file__), "..", "alembic", "versions",
+                              "2026_10_18_1600-5b7c2e91d4a3_add_indexes_for_hot_lookup_paths.py")
+
+# (description, query) pairs mirroring the ORM queries in models/session.py and grader_assignment_tool.py
+HOT_LOOKUPS: List[Tuple[str, str]] = [
+    ("Session.get_session (every API request)",
+     "SELECT * FROM sessions WHERE hashed_token = md5('250000') LIMIT 1"),
+    ("user_is_grader_in_course",
+     "SELECT * FROM course_users WHERE email = 'user200@buffalo.edu' "
+     "AND course_id = (SELECT max(id) FROM courses) LIMIT 1"),
+    ("get_grader_courses",
+     "SELECT * FROM course_users WHERE email = 'user200@buffalo.edu'"),
+    ("course_user_view (grader's conflicts of interest)",
+     "SELECT * FROM course_conflicts_of_interest WHERE course_id = (SELECT max(id) FROM courses) "
+     "AND grader_email = 'user1@buffalo.edu'"),
+    ("course_user_view (student's conflicts of interest)",
+     "SELECT * FROM course_conflicts_of_interest WHERE course_id = (SELECT max(id) FROM courses) "
+     "AND student_email = 'user200@buffalo.edu'"),
+    ("course_grading_assignment_view",
+     "SELECT * FROM course_grading_assignment_pairs "
+     "WHERE course_grading_assignment_id = (SELECT max(id) FROM course_grading_assignments) "
+     "ORDER BY grader_email, student_email"),
+]
+
+
+def load_migration():
+    spec = importlib.util.spec_from_file_location("hot_lookup_indexes_migration", MIGRATION_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def seed(conn: Connection, sessions: int, courses: int, users_per_course: int):
+    print(f"Seeding {sessions} sessions, {courses} courses, and {users_per_course} users per course...")
+    user_id = conn.execute(text(
+        "INSERT INTO users (username, first_name, last_name, person_number, is_admin, login_count) "
+        "VALUES ('explain-hot-lookups', 'Explain', 'Script', 'explain-hot-lookups', false, 0) RETURNING id"
+    )).scalar_one()
+    conn.execute(text(
+        "INSERT INTO sessions (user_id, hashed_token, expires_at) "
+        "SELECT :user_id, md5(i::text), now() + interval '15 days' FROM generate_series(1, :n) AS i"
+    ), {"user_id": user_id, "n": sessions})
+    conn.execute(text(
+        "INSERT INTO courses (name, display_name, created_by_user_id) "
+        "SELECT 'explain-course-' || i, 'Explain Course ' || i, :user_id FROM generate_series(1, :n) AS i"
+    ), {"user_id": user_id, "n": courses})
+    # The first 20 users of every course are graders, the rest are students
+    conn.execute(text(
+        "INSERT INTO course_users (course_id, email, display_name, role, grading_hours) "
+        "SELECT c.id, 'user' || u || '@buffalo.edu', 'User ' || u, "
+        "       (CASE WHEN u <= 20 THEN 'TA' ELSE 'STUDENT' END)::courserole, 0 "
+        "FROM courses c CROSS JOIN generate_series(1, :n) AS u WHERE c.name LIKE 'explain-course-%'"
+    ), {"n": users_per_course})
+    conn.execute(text(
+        "INSERT INTO course_conflicts_of_interest (course_id, grader_email, student_email) "
+        "SELECT c.id, 'user' || (1 + u % 20) || '@buffalo.edu', 'user' || u || '@buffalo.edu' "
+        "FROM courses c CROSS JOIN generate_series(21, :n) AS u WHERE c.name LIKE 'explain-course-%'"
+    ), {"n": users_per_course})
+    conn.execute(text(
+        "INSERT INTO course_grading_assignments "
+        "(course_id, assessment_name, created_by_user_id, archived, assessment_display_name) "
+        "SELECT c.id, 'hw' || a, :user_id, false, 'Homework ' || a "
+        "FROM courses c CROSS JOIN generate_series(1, 5) AS a WHERE c.name LIKE 'explain-course-%'"
+    ), {"user_id": user_id})
+    conn.execute(text(
+        "INSERT INTO course_grading_assignment_pairs "
+        "(course_grading_assignment_id, grader_email, student_email, submission_url, completed, submission_version) "
+        "SELECT a.id, 'user' || (1 + u % 20) || '@buffalo.edu', 'user' || u || '@buffalo.edu', 'https://example.com', "
+        "       false, 1 "
+        "FROM course_grading_assignments a CROSS JOIN generate_series(21, :n) AS u "
+        "WHERE a.created_by_user_id = :user_id"
+    ), {"user_id": user_id, "n": users_per_course})
+    analyze(conn)
+
+
+def analyze(conn: Connection):
+    for table in ["sessions", "course_users", "course_conflicts_of_interest", "course_grading_assignments",
+                  "course_grading_assignment_pairs"]:
+        conn.execute(text(f"ANALYZE {table}"))
+
+
+def explain_all(conn: Connection, heading: str):
+    print()
+    print(f"===== {heading} =====")
+    for description, query in HOT_LOOKUPS:
+        print()
+        print(f"--- {description}")
+        for (line,) in conn.execute(text(f"EXPLAIN ANALYZE {query}")):
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print EXPLAIN ANALYZE for hot lookups before and after indexing.")
+    parser.add_argument("--sessions", type=int, default=500_000)
+    parser.add_argument("--courses", type=int, default=500)
+    parser.add_argument("--users-per-course", type=int, default=400)
+    args = parser.parse_args()
+
+    migration = load_migration()
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            with Operations.context(MigrationContext.configure(conn)):
+                # Start from the state before the migration, even if the database is already upgraded
+                for statement in ["DROP INDEX IF EXISTS ix_sessions_hashed_token",
+                                  "DROP INDEX IF EXISTS ix_course_users_email",
+                                  "DROP INDEX IF EXISTS ix_course_conflicts_of_interest_course_id_student_email"]:
+                    conn.execute(text(statement))
+                seed(conn, args.sessions, args.courses, args.users_per_course)
+                explain_all(conn, "Before 5b7c2e91d4a3")
+                migration.upgrade()
+                analyze(conn)
+                explain_all(conn, "After 5b7c2e91d4a3")
+        finally:
+            transaction.rollback()
+            print()
+            print("Rolled back. The database is unchanged.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# A local stand-in for the Autolab API endpoints the portal uses, for benchmarks and manual testing.
+# It speaks HTTP/1.1 with keep-alive like a real deployment behind a web server, and can add a fixed delay to every
+# response to imitate network and server latency. Data is synthetic and the same for every user and course.
+# Responses carry ETags, and GETs with a matching If-None-Match get 304 Not Modified. An optional rate limit answers
+# 429 with Retry-After like Autolab does.
+#   python -m backend.scripts.fake_autolab --port 8099 --latency 0.02
+# Then point AUTOLAB_ROOT at http://127.0.0.1:8099
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, Tuple, Callable
+from urllib.parse import urlparse, parse_qs
+
+
+def synthetic_responses(students: int) -> Dict[str, Callable[[Dict[str, str]], Dict[str, Any]]]:
+    users = [{"email": f"student{i}@buffalo.edu", "display_name": f"Student {i}", "role": "student"}
+             for i in range(students)]
+    users.append({"email": "grader@buffalo.edu", "display_name": "Grader", "role": "course_assistant"})
+    return {
+        "/oauth/token": lambda params: {
+            "access_token": f"fake-access-token-{time.time()}", "token_type": "Bearer", "expires_in": 7199,
+            "refresh_token": "fake-refresh-token", "created_at": int(time.time())},
+        "/api/ubcseit/admin_check": lambda params: {"is_administrator": False},
+        "/api/ubcseit/user_courses": lambda params: {
+            "email": params.get("email"),
+            "courses": [{"name": f"cse{100 + i}-f26", "display_name": f"CSE {100 + i}", "semester": "f26",
+                         "role": "course_assistant"} for i in range(10)]},
+        "/api/ubcseit/course_users": lambda params: {
+            "course_name": params.get("course_name"), "display_name": params.get("course_name"), "users": users},
+        "/api/ubcseit/course_assessments": lambda params: {
+            "course_name": params.get("course_name"), "display_name": params.get("course_name"),
+            "assessments": [{"name": f"hw{i}", "display_name": f"Homework {i}", "url": f"https://example.com/hw{i}"}
+                            for i in range(10)]},
+        "/api/ubcseit/assessment_submissions": lambda params: {
+            "course_name": params.get("course_name"), "assessment_name": params.get("assessment_name"),
+            "assessment_display_name": params.get("assessment_name"),
+            "submissions": [{"email": user["email"], "display_name": user["display_name"], "version": 1,
+                             "url": "https://example.com/submission"} for user in users]},
+    }
+
+
+class FakeAutolabHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections alive between requests
+    disable_nagle_algorithm = True  # Otherwise the headers and body are delayed by Nagle's algorithm and delayed ACKs
+
+    def __respond(self):
+        parsed = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.latency)
+        handler = self.server.responses.get(parsed.path.rstrip("/"))
+        with self.server.stats_lock:
+            self.server.request_count += 1
+            rate_limited = self.server.over_rate_limit()
+        if rate_limited:
+            self.__send_json(429, json.dumps({"error": "Rate limit exceeded"}).encode("utf-8"), {"Retry-After": "1"})
+            return
+        status, body = (200, handler(params)) if handler else (404, {"error": "Not found"})
+        data = json.dumps(body).encode("utf-8")
+        # Like Rails' ETag middleware, a GET whose body matches If-None-Match gets an empty 304 response
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        if status == 200 and self.command == "GET" and self.headers.get("If-None-Match") == etag:
+            with self.server.stats_lock:
+                self.server.not_modified_count += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.__send_json(status, data, {"ETag": etag} if status == 200 else {})
+
+    def __send_json(self, status: int, data: bytes, headers: Dict[str, str]):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = __respond
+    do_POST = __respond
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output readable
+
+
+class FakeAutolabServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # The default backlog of 5 drops connections when many clients connect at once
+
+    def __init__(self, address: Tuple[str, int], latency: float, students: int = 300, rate_limit: int = 0):
+        super().__init__(address, FakeAutolabHandler)
+        self.latency = latency
+        self.responses = synthetic_responses(students)
+        self.request_count = 0
+        self.not_modified_count = 0
+        self.rate_limited_count = 0
+        self.stats_lock = threading.Lock()
+        # Requests per second before answering 429 with Retry-After, like Rack::Attack in front of Autolab. 0 is off.
+        self.rate_limit = rate_limit
+        self.__window_start = 0
+        self.__window_requests = 0
+
+    def over_rate_limit(self) -> bool:
+        # Must be called with stats_lock held. Counts requests in fixed one second windows.
+        if self.rate_limit <= 0:
+            return False
+        window = int(time.time())
+        if window != self.__window_start:
+            self.__window_start = window
+            self.__window_requests = 0
+        self.__window_requests += 1
+        if self.__window_requests > self.rate_limit:
+            self.rate_limited_count += 1
+            return True
+        return False
+
+    @property
+    def root(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+def start_fake_autolab(latency: float = 0.0, port: int = 0, students: int = 300,
+                       rate_limit: int = 0) -> FakeAutolabServer:
+    # Starts the server in a background thread. Pass port 0 to let the OS choose a free port.
+    server = FakeAutolabServer(("127.0.0.1", port), latency, students, rate_limit)
+    threading.Thread(target=server.serve_forever, name="fake-autolab", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a fake Autolab API server.")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before every response")
+    parser.add_argument("--students", type=int, default=300)
+    parser.add_argument("--rate-limit", type=int, default=0, help="Requests per second before responding 429")
+    args = parser.parse_args()
+    fake = FakeAutolabServer(("127.0.0.1", args.port), args.latency, args.students, args.rate_limit)
+    print(f"Fake Autolab listening on {fake.root}")
+    fake.serve_forever()
@@ -0,0 +1,82 @@
+# A small load generator for comparing worker configurations on I/O-bound endpoints.
+# Start the portal with the sync-equivalent configuration, then with threads, and run the same load against both:
+#   GUNICORN_THREADS=1 gunicorn -c gunicorn.conf.py server:gunicorn_app
+#   GUNICORN_THREADS=8 gunicorn -c gunicorn.conf.py server:gunicorn_app
+#   python -m backend.scripts.load_test http://localhost:5057/api/user_api/tango_histogram/ \
+#       --header "Authorization: $USER_API_KEY" --concurrency 32 --requests 2000
+# Endpoints under /api/ need a session cookie instead, e.g. --cookie "ubcse_autolab_portal_session=..."
+# Keep per-user rate limits in mind when choosing an endpoint; 429s are counted separately.
+
+import argparse
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import requests
+
+
+def run_load(url: str, headers: Dict[str, str], concurrency: int, total_requests: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one_request(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = local.session.get(url, headers=headers, timeout=60).status_code
+        except requests.RequestException:
+            status = "error"
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(total_requests)))
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "duration": duration,
+        "throughput": total_requests / duration,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[int(len(latencies) * 0.95) - 1],
+        "p99": latencies[int(len(latencies) * 0.99) - 1],
+        "mean": statistics.mean(latencies),
+        "statuses": dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send concurrent GET requests to a portal endpoint.")
+    parser.add_argument("url")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--header", action="append", default=[], help='Like "Authorization: key"')
+    parser.add_argument("--cookie", action="append", default=[], help='Like "name=value"')
+    args = parser.parse_args()
+
+    headers: Dict[str, str] = {}
+    for header in args.header:
+        name, value = header.split(":", 1)
+        headers[name.strip()] = value.strip()
+    if args.cookie:
+        headers["Cookie"] = "; ".join(args.cookie)
+
+    result = run_load(args.url, headers, args.concurrency, args.requests)
+    print(f"{args.requests} requests with concurrency {args.concurrency} in {result['duration']:.2f} seconds")
+    print(f"Throughput: {result['throughput']:.1f} requests/second")
+    print(f"Latency: mean {result['mean'] * 1000:.1f} ms, p50 {result['p50'] * 1000:.1f} ms, "
+          f"p95 {result['p95'] * 1000:.1f} ms, p99 {result['p99'] * 1000:.1f} ms")
+    print(f"Statuses: {result['statuses']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,73 @@
+import atexit
+import itertools
 import logging
 import os
+import queue
 import random
-from logging.handlers import RotatingFileHandler
+import time
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional
 
-from flask import Flask, Blueprint, jsonify, request, make_response, g, redirect, abort
+from flask import Flask, Blueprint, Response, jsonify, request, make_response, g, redirect, abort
 from dotenv import load_dotenv
 
 from backend.course_sections import cs
 from backend.grader_assignment_tool import gat
 from backend.per_user_rate_limiter import rate_limit_per_user
+from backend.request_deadline import start_request_deadline
+from backend.connections.async_autolab_api_connection import AsyncAutolabApiConnection
 from backend.connections.autolab_api_connection import AutolabApiConnection
 from backend.connections.infosource_connection import InfoSourceConnection
 from backend.course_store import CourseStore
 from backend.connections.tango_api_connection import TangoApiConnection
-from backend.db import get_db_session
+from backend.connections.throttle import UpstreamThrottle
+from backend.db import LazyDbSession, engine
+from backend.log_server import create_log_file_handler, ACCESS_LOGGER_NAME, JsonSocketHandler
+from backend.metrics import REQUEST_DURATION, render_metrics, instrument_engine
 from backend.models.session import Session
-from backend.models.user import User
+from backend.models.user import User, login_stats
+from backend.session_pruner import SessionPruner
+from backend.tango_history import TangoHistory
+from backend.tango_poller import TangoPoller
+from backend.tango_time_series import RESOLUTIONS as TANGO_SERIES_RESOLUTIONS
 from backend.utils import get_client_ip
 
 __version__ = "2025.0.0"
 logger = logging.getLogger("portal")
+access_logger = logging.getLogger(ACCESS_LOGGER_NAME)
+MAX_LOGGED_BODY_BYTES = 2_000
 load_dotenv()
 app = Flask(__name__)
-app.request_counter = 0
+app.request_counter = itertools.count(1)  # next() on this is atomic, so it's safe across threads
 app.api = Blueprint("api", __name__)
 app.user_api = Blueprint("user_api", __name__)
 app.autolab = AutolabApiConnection(os.getenv("AUTOLAB_ROOT"), os.getenv("AUTOLAB_CLIENT_ID"),
-                                   os.getenv("AUTOLAB_CLIENT_SECRET"), os.getenv("AUTOLAB_CLIENT_CALLBACK"))
-app.tango = TangoApiConnection(os.getenv("TANGO_HOST"), os.getenv("TANGO_KEY"), float(os.getenv("TANGO_MAX_POLL_RATE")))
+                                   os.getenv("AUTOLAB_CLIENT_SECRET"), os.getenv("AUTOLAB_CLIENT_CALLBACK"),
+                                   int(os.getenv("AUTOLAB_HTTP_POOL_SIZE", 10)),
+                                   int(os.getenv("AUTOLAB_HTTP_RETRIES", 2)),
+                                   float(os.getenv("AUTOLAB_TOKEN_REFRESH_MARGIN", 300)),
+                                   UpstreamThrottle(float(os.getenv("AUTOLAB_RATE_LIMIT", 20)),
+                                                    int(os.getenv("AUTOLAB_RATE_BURST", 20)),
+                                                    int(os.getenv("AUTOLAB_BREAKER_FAILURES", 5)),
+                                                    float(os.getenv("AUTOLAB_BREAKER_OPEN_SECONDS", 30)),
+                                                    float(os.getenv("AUTOLAB_THROTTLE_MAX_WAIT", 5))),
+                                   float(os.getenv("AUTOLAB_HTTP_TIMEOUT", 30)),
+                                   float(os.getenv("AUTOLAB_HEDGE_AFTER", 0)))
+app.autolab_async = AsyncAutolabApiConnection(app.autolab, int(os.getenv("AUTOLAB_ASYNC_POOL_SIZE", 10)),
+                                              float(os.getenv("AUTOLAB_HTTP_TIMEOUT", 30)))
+app.tango = TangoApiConnection(os.getenv("TANGO_HOST"), os.getenv("TANGO_KEY"),
+                               int(os.getenv("TANGO_HTTP_POOL_SIZE", 4)), float(os.getenv("TANGO_HTTP_TIMEOUT", 5)))
+app.tango_poller = TangoPoller(app.tango,
+                               TangoHistory(retention_seconds=float(os.getenv("TANGO_HISTORY_DAYS", 31)) * 86400),
+                               float(os.getenv("TANGO_MAX_POLL_RATE")))
 app.infosource = InfoSourceConnection(os.getenv("INFOSOURCE_USERNAME"),
-                                      os.getenv("INFOSOURCE_PASSWORD"), os.getenv("INFOSOURCE_DSN"))
+                                      os.getenv("INFOSOURCE_PASSWORD"), os.getenv("INFOSOURCE_DSN"),
+                                      float(os.getenv("INFOSOURCE_CALL_TIMEOUT", 30)))
 app.course_store = CourseStore(app.infosource)
 app.developer_mode = os.getenv("DEVELOPER_MODE", "").lower() == "true"
+app.session_pruner = SessionPruner(float(os.getenv("SESSION_RETENTION_DAYS", 30)),
+                                   float(os.getenv("SESSION_PRUNE_INTERVAL", 3600)),
+                                   int(os.getenv("SESSION_PRUNE_BATCH_SIZE", 1000)))
 
 
 def init_logging():
@@ -62,23 +97,79 @@ def init_logging():
                 record.indent = ""
             return True
 
-    os.makedirs("mount/logs", exist_ok=True)
+    # Formatting and disk writes happen on a background thread, not the request thread. Under gunicorn, records are
+    # sent to the log server in the master process (see gunicorn.conf.py) so only one process writes and rotates the
+    # log file. Without gunicorn, this process writes the file itself.
+    log_server = os.getenv("PORTAL_LOG_SERVER")
+    if log_server:
+        host, port = log_server.rsplit(":", 1)
+        target = JsonSocketHandler(host, int(port))
+    else:
+        target = create_log_file_handler("mount/logs")
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, target)
+    listener.start()
+    atexit.register(listener.stop)  # Writes out anything still in the queue
+
     logger.setLevel(logging.DEBUG if app.developer_mode else logging.INFO)
-    handler = RotatingFileHandler("mount/logs/portal.log", maxBytes=10_000_000, backupCount=5_000)
-    formatter = logging.Formatter("%(asctime)s %(levelname)s %(request_id)s "
-                                  "%(username)s%(indent)s %(message)s (%(module)s)")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
     logger.addFilter(RequestContextFilter())
+    # The access log has its own JSON format, so it doesn't go through the portal log's filter
+    access_logger.propagate = False
+    access_logger.setLevel(logging.INFO)
+    access_logger.addHandler(QueueHandler(log_queue))
     logger.debug("Logging initialized")
 
 
+def abbreviate_body(data: bytes) -> str:
+    if len(data) <= MAX_LOGGED_BODY_BYTES:
+        return str(data)
+    return f"{data[:MAX_LOGGED_BODY_BYTES]}... ({len(data)} bytes total)"
+
+
+def log_request_finished(response):
+    # Logs the end of a request to the portal log and writes one machine-readable line to the access log.
+    # Handlers and error handlers mark errors by setting g.error. Other error responses are read back to find the
+    # message, which is cheap because they're small. Successful responses are never decoded.
+    error = g.get("error")
+    if error is None and response.status_code >= 400 and response.is_json:
+        error = (response.get_json(silent=True) or {}).get("error")
+    if error:
+        logger.info(f"Error: {error}")
+    if logger.isEnabledFor(logging.DEBUG) and not response.is_streamed:
+        logger.debug(f"Response: {abbreviate_body(response.get_data())}")
+
+    duration = time.perf_counter() - g.request_start
+    duration_ms = duration * 1000
+    route = request.url_rule.rule if request.url_rule else None
+    REQUEST_DURATION.labels(request.blueprint, route, request.method, response.status_code).observe(duration)
+    upstream_ms = {service: round(seconds * 1000, 1) for service, seconds in g.get("upstream_seconds", {}).items()}
+    log = logger.debug if request.blueprint == "user_api" else logger.info
+    log(f"Finished request #{g.request_number} with status {response.status} in {duration_ms:.0f} ms")
+    user = g.get("user")
+    access_logger.info("request", extra={"fields": {
+        "request_id": g.request_number,
+        "method": request.method,
+        "route": route,
+        "path": request.path,
+        "blueprint": request.blueprint,
+        "status": response.status_code,
+        "duration_ms": round(duration_ms, 1),
+        "upstream_ms": upstream_ms,
+        "upstream_total_ms": round(sum(upstream_ms.values()), 1),
+        "user": user.username if user else None,
+        "ip": get_client_ip(request),
+        "error": error,
+    }})
+
+
 @app.api.before_request
 def before_request():
-    app.request_counter += 1
+    g.request_start = time.perf_counter()
+    start_request_deadline()
     g.request_initiated = False
-    g.request_number = app.request_counter
-    g.db = get_db_session()
+    g.request_number = next(app.request_counter)
+    g.db = LazyDbSession()
     session_cookie = request.cookies.get("ubcse_autolab_portal_session", "")
     g.user = Session.get_user(session_cookie)
     logger.info(
@@ -86,24 +177,20 @@ def before_request():
         f"from {g.user.username if g.user else '(unknown user)'} "
         f"at {get_client_ip(request)}")
     g.request_initiated = True
-    data = request.get_data()
-    if len(data) > 0:
-        logger.debug(f"Request body: {data}")
+    if logger.isEnabledFor(logging.DEBUG) and request.content_length:
+        logger.debug(f"Request body: {abbreviate_body(request.get_data())}")
 
 
 @app.api.after_request
 def after_request(response):
     g.db.close()
-    rjson = response.json
-    if rjson and rjson.get("error"):
-        logger.info(f"Error: {rjson['error']}")
-    logger.debug(f"Response: {rjson}")
-    logger.info(f"Finished request #{g.request_number} with status {response.status}")
+    log_request_finished(response)
     return response
 
 
 @app.errorhandler(500)
 def internal_server_error(e):
+    g.error = "500: Internal server error"
     return jsonify({
         "success": False,
         "error": "500: Internal server error"
@@ -114,6 +201,7 @@ def internal_server_error(e):
 def bad_request_error(e):
     message = str(e.description) if e else "400: Bad request"
     # Only return the custom message for 400 since it's used in generic ways. Saying "Bad Request" is confusing
+    g.error = message
     return jsonify({
         "success": False,
         "error": message
@@ -123,6 +211,7 @@ def bad_request_error(e):
 @app.errorhandler(401)
 def unauthorized_error(e):
     message = str(e) if e else "401: Authentication required"
+    g.error = message
     return jsonify({
         "success": False,
         "error": message
@@ -132,6 +221,7 @@ def unauthorized_error(e):
 @app.errorhandler(403)
 def forbidden_error(e):
     message = str(e) if e else "403: You don't have permission to access this resource"
+    g.error = message
     return jsonify({
         "success": False,
         "error": message
@@ -141,12 +231,23 @@ def forbidden_error(e):
 @app.errorhandler(404)
 def not_found_error(e):
     message = str(e) if e else "404: Resource not found"
+    g.error = message
     return jsonify({
         "success": False,
         "error": message
     }), 404
 
 
+@app.errorhandler(504)
+def gateway_timeout_error(e):
+    message = str(e) if e else "504: The request took too long"
+    g.error = message
+    return jsonify({
+        "success": False,
+        "error": message
+    }), 504
+
+
 @app.api.route("/login/", methods=["GET", "POST"])
 def login():
     username = request.headers.get("Uid")
@@ -160,17 +261,18 @@ def login():
             "success": False,
             "error": "Missing required headers from Shibboleth."
         }), 400
+    # Everything below is committed in one transaction by Session.create
     user = User.get_by_username(username)
     if user is None:
         user = User.create(username, first_name, last_name, person_number)
-    user.login()
     if user.first_name != first_name or user.last_name != last_name:
         # Update the user's name if it has changed
         logger.info(f"Updating user {user.username} with new name from Shibboleth {first_name} {last_name}")
         user.first_name = first_name
         user.last_name = last_name
-        g.db.commit()
     session, token = Session.create(user)
+    user.login()  # Only counted once the session has been committed, since a failed commit means no login happened
+    Session.forget_user(user)  # In case the name changed
     resp = make_response(redirect("/portal"))
     resp.set_cookie("ubcse_autolab_portal_session", token, samesite="Strict", secure=True, httponly=True,
                     max_age=1735707600)
@@ -284,6 +386,7 @@ def set_preferred_name():
 
     g.user.preferred_name = preferred_name
     g.db.commit()
+    Session.forget_user(g.user)
     logger.info(f"User {g.user.username} set their preferred name to {preferred_name}.")
 
     return jsonify({
@@ -393,6 +496,7 @@ def admin_update():
     if g.user.is_admin:
         g.user.is_admin = False
         g.db.commit()
+        Session.forget_user(g.user)
         logger.info(f"User {g.user.username} is no longer an admin on the portal")
         return jsonify({
             "success": True,
@@ -411,6 +515,7 @@ def admin_update():
     if is_autolab_admin:
         g.user.is_admin = True
         g.db.commit()
+        Session.forget_user(g.user)
         logger.info(f"User {g.user.username} is now an admin on the portal")
         return jsonify({
             "success": True,
@@ -446,14 +551,38 @@ def tango_stats():
     })
 
 
+@app.api.route("/tango-stats/series/")
+@rate_limit_per_user(2, 5)
+def tango_stats_series():
+    if g.user is None:
+        return jsonify({
+            "success": False,
+            "error": "You are not logged in."
+        }), 401
+    # Every resolution at once, so the page can switch between them without another request
+    return jsonify({
+        "success": True,
+        "data": [app.tango.get_submission_time_series(step) for step in TANGO_SERIES_RESOLUTIONS]
+    })
+
+
+def get_series_step() -> int:
+    # ?step=60 for submissions per minute over the past day (the default), ?step=3600 per hour over 30 days
+    step = request.args.get("step", "60")
+    if not step.isdigit() or int(step) not in TANGO_SERIES_RESOLUTIONS:
+        abort(400, f"step must be one of {', '.join(str(s) for s in TANGO_SERIES_RESOLUTIONS)}")
+    return int(step)
+
+
 @app.user_api.before_request
 def user_api_before_request():
-    app.request_counter += 1
+    g.request_start = time.perf_counter()
+    start_request_deadline()
     g.request_initiated = False
-    g.request_number = app.request_counter
+    g.request_number = next(app.request_counter)
     if request.headers.get("Authorization", None) != os.getenv("USER_API_KEY"):
         abort(403)
-    g.db = get_db_session()
+    g.db = LazyDbSession()
     logger.debug(
         f"{request.method} {request.path} "
         f"from USER API "
@@ -466,18 +595,45 @@ def user_api_after_request(response):
     if hasattr(g, "db"):
         # If the request was aborted, the db session won't exist
         g.db.close()
-    logger.debug(f"Finished request #{g.request_number} with status {response.status}")
+    log_request_finished(response)
     return response
 
 
 @app.user_api.route("/tango_histogram/", methods=["GET"])
 def tango_histogram():
-    return jsonify(app.tango.get_recent_submissions_histogram())
+    # Optional ?seconds=60,3600,86400 to count submissions in other windows than the default ones
+    seconds = request.args.get("seconds")
+    if seconds is None:
+        return jsonify(app.tango.get_recent_submissions_histogram())
+    try:
+        sample_seconds = [int(window) for window in seconds.split(",")]
+    except ValueError:
+        abort(400, "seconds must be a comma-separated list of whole numbers of seconds")
+    if not 0 < len(sample_seconds) <= 1000 or min(sample_seconds) <= 0:
+        abort(400, "seconds must have between 1 and 1000 positive windows")
+    return jsonify(app.tango.get_recent_submissions_histogram(sample_seconds))
+
+
+@app.user_api.route("/tango_series/", methods=["GET"])
+def tango_series():
+    return jsonify(app.tango.get_submission_time_series(get_series_step()))
+
+
+@app.user_api.route("/metrics/", methods=["GET"])
+def metrics():
+    # Prometheus metrics for all gunicorn workers combined
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
 
 def initialize():
     with app.app_context():
         init_logging()
+    instrument_engine(engine)
+    app.session_pruner.start()
+    login_stats.start()
+    app.autolab_async.start()
+    app.tango_poller.start()
     # If, in the future, I want to use Alembic, remove this line:
     # db.initialize()  # Let Alembic handle this instead
     app.register_blueprint(app.user_api, url_prefix="/api/user_api")  # The "user API" is for the Autolab Lightsaber
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from backend.db import engine
+from backend.metrics import SESSIONS_PRUNED
+
+logger = logging.getLogger("portal")
+
+# Any number works as long as nothing else uses it for a Postgres advisory lock
+PRUNE_ADVISORY_LOCK_KEY = 4_207_117
+
+
+class SessionPruner:
+    # Deletes sessions that expired more than `retention_days` ago, in batches of `batch_size` rows so no single
+    # statement holds locks on the sessions table for long. Every gunicorn worker runs one of these, but a Postgres
+    # advisory lock makes sure only one of them prunes at a time.
+    # Logged out sessions are also only deleted once they have expired. SessionRevocationList reads them to reject
+    # their signed tokens until then.
+
+    def __init__(self, retention_days: float, interval_seconds: float, batch_size: int,
+                 initial_delay_seconds: float = 60):
+        self.retention = timedelta(days=retention_days)
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.initial_delay_seconds = initial_delay_seconds
+
+        # Metrics
+        self.runs = 0
+        self.rows_pruned_total = 0
+        self.last_run_rows_pruned = 0
+        self.last_run_seconds = 0.0
+        self.last_run_at = None
+
+    def __repr__(self):
+        return f"<SessionPruner retention {self.retention} every {self.interval_seconds} seconds " \
+               f"({self.rows_pruned_total} rows pruned in {self.runs} runs)>"
+
+    def prune(self) -> int:
+        # Runs one pruning pass and returns the number of deleted rows, or 0 if another worker is already pruning
+        start = time.perf_counter()
+        cutoff = datetime.now(timezone.utc) - self.retention
+        deleted_total = 0
+        with engine.connect() as conn:
+            if not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": PRUNE_ADVISORY_LOCK_KEY}).scalar():
+                logger.debug("Another worker is already pruning sessions")
+                conn.rollback()
+                return 0
+            try:
+                while True:
+                    deleted = conn.execute(text(
+                        "DELETE FROM sessions WHERE id IN ("
+                        "    SELECT id FROM sessions WHERE expires_at < :cutoff LIMIT :batch"
+                        ")"
+                    ), {"cutoff": cutoff, "batch": self.batch_size}).rowcount
+                    conn.commit()
+                    deleted_total += deleted
+                    if deleted < self.batch_size:
+                        break
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": PRUNE_ADVISORY_LOCK_KEY})
+                conn.commit()
+
+        self.runs += 1
+        self.rows_pruned_total += deleted_total
+        SESSIONS_PRUNED.inc(deleted_total)
+        self.last_run_rows_pruned = deleted_total
+        self.last_run_seconds = time.perf_counter() - start
+        self.last_run_at = datetime.now(timezone.utc)
+        logger.info(f"Pruned {deleted_total} sessions that expired before {cutoff} in {self.last_run_seconds:.3f} "
+                    f"seconds. {self}")
+        return deleted_total
+
+    def __run_forever(self):
+        time.sleep(self.initial_delay_seconds)
+        while True:
+            try:
+                self.prune()
+            except Exception as e:
+                logger.error(f"Failed to prune sessions: {e}")
+            time.sleep(self.interval_seconds)
+
+    def start(self):
+        logger.debug(f"Starting {self}")
+        threading.Thread(target=self.__run_forever, name="session-pruner", daemon=True).start()
+
@@ -0,0 +1,112 @@
+import base64
+import functools
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from typing import Optional, Tuple, FrozenSet
+
+from sqlalchemy import text
+
+from backend.db import engine
+from backend.utils import generate_random_string
+
+logger = logging.getLogger("portal")
+
+# In "signed" mode, session cookies carry the session ID, user ID, and expiration time along with an HMAC signature,
+# so they can be verified without looking up the session in the database. The sessions table is still the source of
+# truth for logging out: logged out sessions are kept in an in-memory revocation list that's refreshed periodically.
+# Tokens from the default "opaque" mode are still accepted in signed mode, so switching modes doesn't log anyone out.
+SESSION_TOKEN_MODE = os.getenv("SESSION_TOKEN_MODE", "opaque").lower()
+SESSION_SIGNING_KEY = os.getenv("SESSION_SIGNING_KEY", "")
+SESSION_REVOCATION_REFRESH = float(os.getenv("SESSION_REVOCATION_REFRESH", 10))
+
+TOKEN_VERSION = "v1"
+
+
+@functools.lru_cache(maxsize=None)  # Only complain about a bad configuration once
+def signed_tokens_enabled() -> bool:
+    if SESSION_TOKEN_MODE != "signed":
+        return False
+    if len(SESSION_SIGNING_KEY) < 32:
+        logger.error("SESSION_TOKEN_MODE is signed, but SESSION_SIGNING_KEY is missing or shorter than 32 characters. "
+                     "Falling back to opaque session tokens.")
+        return False
+    return True
+
+
+def is_signed_token(token: str) -> bool:
+    # Opaque tokens come from secrets.token_urlsafe, which never contains a period
+    return token.startswith(f"{TOKEN_VERSION}.")
+
+
+def token_signature(message: str) -> str:
+    digest = hmac.new(SESSION_SIGNING_KEY.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+def sign_session_token(session_id: int, user_id: int, expires_at: float) -> str:
+    # expires_at is a Unix timestamp
+    # The random nonce keeps tokens unguessable and their hashes unique, like opaque tokens
+    message = f"{TOKEN_VERSION}.{session_id}.{user_id}.{int(expires_at)}.{generate_random_string(32)}"
+    return f"{message}.{token_signature(message)}"
+
+
+def verify_session_token(token: str) -> Optional[Tuple[int, int, int]]:
+    # Returns (session_id, user_id, expires_at) if the token is authentic and unexpired, None otherwise
+    parts = token.split(".")
+    if len(parts) != 6 or parts[0] != TOKEN_VERSION:
+        return None
+    message, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, token_signature(message)):
+        logger.warning("Rejected session token with an invalid signature")
+        return None
+    try:
+        session_id, user_id, expires_at = int(parts[1]), int(parts[2]), int(parts[3])
+    except ValueError:
+        return None
+    if expires_at < time.time():
+        logger.warning(f"Old session rejected <Session {session_id}> (signed token expired)")
+        return None
+    return session_id, user_id, expires_at
+
+
+class SessionRevocationList:
+    # The IDs of unexpired sessions that have been logged out, refreshed from the database every `refresh_interval`
+    # seconds. Sessions logged out by this worker are added immediately; other workers see them after a refresh.
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.__revoked: FrozenSet[int] = frozenset()
+        self.__last_refresh = 0.0
+        self.__refresh_lock = threading.Lock()
+
+    def __refresh_if_necessary(self):
+        if time.monotonic() - self.__last_refresh < self.refresh_interval:
+            return
+        # Only one thread refreshes. The others keep using the current list instead of waiting.
+        if not self.__refresh_lock.acquire(blocking=False):
+            return
+        try:
+            with engine.connect() as conn:
+                rows = conn.execute(text("SELECT id FROM sessions "
+                                         "WHERE logged_out_at IS NOT NULL AND expires_at > CURRENT_TIMESTAMP")).all()
+            self.__revoked = frozenset(row[0] for row in rows)
+            self.__last_refresh = time.monotonic()
+            logger.debug(f"Refreshed session revocation list with {len(self.__revoked)} sessions")
+        except Exception as e:
+            logger.error(f"Failed to refresh session revocation list. Using the previous one. {e}")
+        finally:
+            self.__refresh_lock.release()
+
+    def is_revoked(self, session_id: int) -> bool:
+        self.__refresh_if_necessary()
+        return session_id in self.__revoked
+
+    def revoke(self, session_id: int):
+        self.__revoked = self.__revoked | {session_id}
+
+
+revoked_sessions = SessionRevocationList(SESSION_REVOCATION_REFRESH)
@@ -0,0 +1,124 @@
+import bisect
+import logging
+import struct
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from backend.connections.tango_api_connection import TangoApiConnection, TangoSnapshot
+from backend.tango_time_series import TangoTimeSeries
+from backend.utils import write_file_atomically
+
+logger = logging.getLogger("portal")
+
+# One record per job: the Tango job ID and the time the job was submitted as a Unix timestamp
+RECORD = struct.Struct("<qd")
+
+
+class TangoHistory:
+    # Every Tango job ever seen, so histograms can cover more time than Tango itself keeps jobs for
+    # Jobs are identified by their ID and submission date, since Tango reuses IDs after a restart. Only jobs that
+    # weren't in the previous poll are parsed, and they are appended to an append-only file of RECORDs. Records older
+    # than retention_seconds are dropped by rewriting the file once they make up half of it.
+    #
+    # Only the worker polling Tango uses this, see TangoPoller. It reads the file on first use, which picks up
+    # everything the previous polling worker wrote.
+
+    def __init__(self, path: str = "mount/tango_history.bin", retention_seconds: float = 31 * 86400):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.__start_times: Optional[array] = None  # Sorted start times of all records, loaded on first use
+        self.__record_count = 0  # Number of records in the file, including expired ones
+        self.__seen: Dict[Tuple[int, str], None] = {}  # (job ID, trace_date_string) of the jobs in the previous poll
+        self.__series = TangoTimeSeries()
+
+    def __repr__(self):
+        return f"<TangoHistory of {len(self.__start_times or [])} jobs in {self.path}>"
+
+    @staticmethod
+    def __job_id(job: dict) -> int:
+        try:
+            return int(job.get("id"))
+        except (TypeError, ValueError):
+            return -1
+
+    def __load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        # A crash in the middle of an append can leave part of a record at the end
+        usable = len(data) - len(data) % RECORD.size
+        records = list(RECORD.iter_unpack(data[:usable]))
+        cutoff = time.time() - self.retention_seconds
+        retained = [(job_id, start_time) for job_id, start_time in records if start_time >= cutoff]
+        self.__start_times = array("d", sorted(start_time for _, start_time in retained))
+        self.__series = TangoTimeSeries()
+        for start_time in self.__start_times:
+            self.__series.add(start_time)
+        self.__record_count = len(records)
+        # Jobs Tango still has must not be added again, so start from everything that is already in the file
+        self.__seen = {(job_id, self.__date_string(start_time)): None for job_id, start_time in retained}
+        if usable != len(data) or len(retained) < len(records):
+            self.__rewrite(retained)
+        logger.info(f"Loaded {self}")
+
+    @staticmethod
+    def __date_string(start_time: float) -> str:
+        # The same string as TangoApiConnection.trace_date_string gives for a job submitted at start_time
+        return " ".join(time.asctime(time.gmtime(start_time)).split())
+
+    def __rewrite(self, records: List[Tuple[int, float]]):
+        # Atomic, so a crash never leaves a partially written history
+        write_file_atomically(self.path, b"".join(RECORD.pack(job_id, start_time) for job_id, start_time in records))
+        self.__record_count = len(records)
+
+    def ingest(self, jobs: List[dict]) -> int:
+        # Adds the jobs that weren't in the previous poll and returns how many there were
+        if self.__start_times is None:
+            self.__load()
+        seen: Dict[Tuple[int, str], None] = {}
+        new_records: List[Tuple[int, float]] = []
+        for job in jobs:
+            date_string = TangoApiConnection.trace_date_string(job)
+            if date_string is None:
+                continue
+            key = (self.__job_id(job), date_string)
+            if key in seen:
+                continue
+            seen[key] = None
+            if key in self.__seen:
+                continue
+            start_time = TangoApiConnection.parse_date_string(date_string)
+            if start_time is not None:
+                new_records.append((key[0], start_time))
+        # Jobs Tango no longer has can't come back, so only the current ones need to be remembered
+        self.__seen = seen
+
+        if new_records:
+            with open(self.path, "ab") as f:
+                f.write(b"".join(RECORD.pack(job_id, start_time) for job_id, start_time in new_records))
+            self.__record_count += len(new_records)
+            for _, start_time in new_records:
+                self.__series.add(start_time)
+            # New jobs are almost always the latest ones, which sorted() handles in about linear time
+            self.__start_times = array("d", sorted(self.__start_times + array("d", (t for _, t in new_records))))
+        self.__expire()
+        return len(new_records)
+
+    def __expire(self):
+        cutoff = time.time() - self.retention_seconds
+        expired = bisect.bisect_left(self.__start_times, cutoff)
+        if expired == 0:
+            return
+        del self.__start_times[:expired]
+        if len(self.__start_times) < self.__record_count // 2:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            records = RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size])
+            self.__rewrite([record for record in records if record[1] >= cutoff])
+
+    def snapshot(self) -> TangoSnapshot:
+        # A copy, since the snapshot is shared with request threads and the history keeps changing
+        return TangoSnapshot(time.time(), array("d", self.__start_times or []), self.__series.copy())
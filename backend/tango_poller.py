@@ -0,0 +1,114 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from array import array
+from typing import Optional, Tuple
+
+from backend.connections.tango_api_connection import TangoApiConnection, TangoSnapshot
+from backend.tango_history import TangoHistory
+from backend.tango_time_series import TangoTimeSeries
+from backend.utils import write_file_atomically
+
+logger = logging.getLogger("portal")
+
+# First value of the snapshot file. Files in any other format are ignored until the polling worker replaces them.
+SNAPSHOT_FORMAT = 2.0
+
+
+class TangoPoller:
+    # Polls Tango every `interval_seconds` in the background, adds new jobs to a TangoHistory, and publishes the
+    # history as TangoApiConnection.snapshot, so requests never wait for Tango. Every gunicorn worker runs one of
+    # these, but only the worker holding an exclusive flock on lock_path polls. It writes each snapshot to
+    # snapshot_path, and the other workers load the file when it changes. If the polling worker exits, the lock is
+    # released and another worker takes over within check_interval_seconds.
+    #
+    # The snapshot file is an array of doubles: SNAPSHOT_FORMAT, the time the snapshot was taken, the time series (see
+    # TangoTimeSeries.to_array), then the sorted job start times.
+
+    def __init__(self, tango: TangoApiConnection, history: TangoHistory, interval_seconds: float,
+                 snapshot_path: str = "mount/tango_snapshot.bin", lock_path: str = "mount/tango_poller.lock",
+                 check_interval_seconds: float = 1):
+        self.tango = tango
+        self.history = history
+        self.interval_seconds = interval_seconds
+        self.snapshot_path = snapshot_path
+        self.lock_path = lock_path
+        self.check_interval_seconds = check_interval_seconds
+        self.__lock_file = None  # Open while this worker is the one polling
+        self.__loaded_file: Optional[Tuple[int, int, int]] = None  # Inode, modification time and size last loaded
+
+    def __repr__(self):
+        return f"<TangoPoller every {self.interval_seconds} seconds, " \
+               f"{'polling' if self.__lock_file is not None else 'following'}, " \
+               f"{len(self.tango.snapshot.start_times)} jobs>"
+
+    def __try_to_lead(self) -> bool:
+        # Returns whether this worker holds the poller lock, taking it if no other worker does
+        if self.__lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.__lock_file = lock_file  # Kept open, and so locked, for the life of the process
+        logger.info(f"This worker is now polling Tango for all workers. {self}")
+        return True
+
+    def poll(self):
+        # Adds new jobs from Tango to the history, publishes it to this worker and writes it for the others
+        start = time.perf_counter()
+        new_jobs = self.history.ingest(self.tango.fetch_jobs())
+        snapshot = self.history.snapshot()
+        data = array("d", [SNAPSHOT_FORMAT, snapshot.taken_at])
+        data.extend(snapshot.series.to_array())
+        data.extend(snapshot.start_times)
+        write_file_atomically(self.snapshot_path, data.tobytes())  # The other workers may be loading it right now
+        self.tango.snapshot = snapshot
+        logger.debug(f"Polled Tango and found {new_jobs} new jobs in {time.perf_counter() - start:.3f} seconds. "
+                     f"{self}")
+
+    def load(self) -> bool:
+        # Loads the snapshot file written by the polling worker if it changed since the last load
+        # Returns whether a new snapshot was published to this worker
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return False
+        file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_id == self.__loaded_file:
+            return False
+        data = array("d")
+        with open(self.snapshot_path, "rb") as f:
+            data.frombytes(f.read())
+        self.__loaded_file = file_id
+        series_end = 2 + TangoTimeSeries.array_size()
+        if len(data) < series_end or data[0] != SNAPSHOT_FORMAT:
+            return False
+        self.tango.snapshot = TangoSnapshot(data[1], data[series_end:],
+                                            TangoTimeSeries.from_array(data[2:series_end]))
+        return True
+
+    def __run_forever(self):
+        next_poll = 0.0
+        while True:
+            try:
+                if self.__try_to_lead():
+                    if time.monotonic() >= next_poll:
+                        next_poll = time.monotonic() + self.interval_seconds
+                        self.poll()
+                else:
+                    self.load()
+            except Exception as e:
+                # The exception's message is left out because it can include a Tango URL, and Tango URLs contain the key
+                logger.error(f"Failed to update the Tango snapshot ({type(e).__name__}). {self}")
+            time.sleep(self.check_interval_seconds)
+
+    def start(self):
+        # A snapshot left by a previous run, or by the polling worker, is served until this worker's first update
+        self.load()
+        logger.debug(f"Starting {self}")
+        threading.Thread(target=self.__run_forever, name="tango-poller", daemon=True).start()
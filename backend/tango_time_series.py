@@ -0,0 +1,71 @@
+from array import array
+from typing import Dict, List, Tuple
+
+# Seconds per bucket to number of buckets kept: every minute of the last day and every hour of the last 30 days
+RESOLUTIONS: Dict[int, int] = {60: 1440, 3600: 720}
+
+
+class TangoTimeSeries:
+    # Tango submission counts per minute and per hour in fixed-size ring buffers, so the memory used doesn't depend
+    # on the number of jobs. Each ring holds the most recent buckets up to its newest one (its head). Adding a job
+    # after the head moves the head forward and clears the buckets it passes, which drops the oldest ones.
+
+    def __init__(self):
+        self.__rings: Dict[int, array] = {step: array("q", bytes(8 * slots)) for step, slots in RESOLUTIONS.items()}
+        self.__heads: Dict[int, int] = {step: 0 for step in RESOLUTIONS}  # Newest bucket, as time // step
+
+    def add(self, start_time: float):
+        # Counts one job submitted at start_time, a Unix timestamp
+        for step, slots in RESOLUTIONS.items():
+            bucket = int(start_time // step)
+            self.__advance(step, bucket)
+            if bucket > self.__heads[step] - slots:
+                self.__rings[step][bucket % slots] += 1
+
+    def __advance(self, step: int, bucket: int):
+        ring = self.__rings[step]
+        slots = RESOLUTIONS[step]
+        head = self.__heads[step]
+        if bucket <= head:
+            return
+        if bucket - head >= slots:
+            ring[:] = array("q", bytes(8 * slots))
+        else:
+            for cleared in range(head + 1, bucket + 1):
+                ring[cleared % slots] = 0
+        self.__heads[step] = bucket
+
+    def counts(self, step: int, now: float) -> Tuple[float, List[int]]:
+        # Returns the start time of the oldest bucket and the counts of every bucket up to the one containing now,
+        # oldest first. Buckets after the head had no submissions yet.
+        ring = self.__rings[step]
+        slots = RESOLUTIONS[step]
+        head = self.__heads[step]
+        newest = int(now // step)
+        counts = [ring[bucket % slots] if head - slots < bucket <= head else 0
+                  for bucket in range(newest - slots + 1, newest + 1)]
+        return float((newest - slots + 1) * step), counts
+
+    @staticmethod
+    def array_size() -> int:
+        return len(RESOLUTIONS) + sum(RESOLUTIONS.values())
+
+    def to_array(self) -> array:
+        # The heads, then the rings, as doubles to fit in TangoPoller's snapshot file
+        data = array("d", (self.__heads[step] for step in RESOLUTIONS))
+        for step in RESOLUTIONS:
+            data.extend(float(count) for count in self.__rings[step])
+        return data
+
+    @classmethod
+    def from_array(cls, data: array) -> "TangoTimeSeries":
+        series = cls()
+        offset = len(RESOLUTIONS)
+        for i, (step, slots) in enumerate(RESOLUTIONS.items()):
+            series.__heads[step] = int(data[i])
+            series.__rings[step] = array("q", (int(count) for count in data[offset:offset + slots]))
+            offset += slots
+        return series
+
+    def copy(self) -> "TangoTimeSeries":
+        return self.from_array(self.to_array())
@@ -0,0 +1,46 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from flask import g, has_request_context
+
+from backend.metrics import UPSTREAM_DURATION, UPSTREAM_ERRORS
+
+# Calls made for one request can run on several threads at once, like the workers of a batch fetch
+_upstream_seconds_lock = threading.Lock()
+
+
+@contextmanager
+def time_upstream(service: str, operation: str, upstream_seconds: Optional[Dict[str, float]] = None):
+    # Records the time spent inside the block in the upstream latency metrics, and counts an error if the block raises.
+    # During a request, the time is also added to the request's total for the service (like "autolab"), which is
+    # reported in the access log. Code running for a request on another thread passes that request's
+    # g.upstream_seconds as upstream_seconds instead.
+    # `operation` identifies the kind of call, like an API path. Don't include IDs or other unbounded values in it.
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count_upstream_error(service, operation)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        UPSTREAM_DURATION.labels(service, operation).observe(elapsed)
+        if upstream_seconds is None:
+            upstream_seconds = current_upstream_seconds()
+        if upstream_seconds is not None:
+            with _upstream_seconds_lock:
+                upstream_seconds[service] = upstream_seconds.get(service, 0.0) + elapsed
+
+
+def current_upstream_seconds() -> Optional[Dict[str, float]]:
+    # The current request's upstream time per service, or None outside of a request
+    if not has_request_context():
+        return None
+    return g.setdefault("upstream_seconds", {})
+
+
+def count_upstream_error(service: str, operation: str):
+    # For failures that don't raise inside time_upstream, like an error status code
+    UPSTREAM_ERRORS.labels(service, operation).inc()
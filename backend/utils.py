@@ -33,6 +33,17 @@ def get_client_ip(request):
         return request.remote_addr
 
 
+def write_file_atomically(path: str, data: bytes, permissions: int = 0o666):
+    # Replaces the file at path with data. Readers see either the old file or the new one, never a partial write,
+    # since the data goes to a temporary file that is then renamed over path.
+    # permissions applies from the moment the temporary file is created, so secrets are never readable by others
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions)
+    with open(fd, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, path)
+
+
 def class_meeting_pattern_source_key_to_days_code(class_meeting_pattern_source_key: str) -> int:
     # Converts something like "MWF" to 42
     day_values = {
@@ -0,0 +1,5 @@
+export interface TangoTimeSeries {
+  step: number; // Seconds per bucket
+  start: number; // Unix timestamp of the start of the first bucket
+  counts: number[]; // Submissions per bucket, oldest first
+}